@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import runpy
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from time import perf_counter, time
+from datetime import datetime
+from collections import Counter
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Benchmark of updateServices.py against the stand-in arcpy and portal in bench/stubs. Each
+# benchmark builds a synthetic settings.config and portal in a scratch folder and runs the
+# real script in a child process, so every run starts from a clean interpreter. Results are
+# printed as JSON with the commit they were measured on and can be appended to a file and
+# compared with --compare.
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+STUBS = os.path.join(BENCH, "stubs")
+TYPES = ["FEATURE", "UPSERT", "REPLACEVECTORTILE", "REPLACETILE"]
+CLEAN_PREFIX = "VT_Bench_"
+OWNER = "bench"
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Benchmarks updateServices.py against a simulated ArcGIS Pro and portal")
+    parser.add_argument("--label", default="", help="name of the scenario in the results")
+    parser.add_argument("--services", type=int, default=200, help="number of services in the synthetic configuration")
+    parser.add_argument("--projects", type=int, default=20, help="number of ArcGIS Pro projects the services are spread over")
+    parser.add_argument("--types", default=",".join(TYPES), help="comma separated service types, assigned in turn")
+    parser.add_argument("--clean", type=int, default=2000, help="number of items matched by the CLEAN task, 0 for no task")
+    parser.add_argument("--clean-owner", action="store_true", help="give the CLEAN task an owner so it uses the content index")
+    parser.add_argument("--clean-workers", type=int, default=1, help="workers of the CLEAN task")
+    parser.add_argument("--clean-batch", type=int, default=1, help="batch_size of the CLEAN task")
+    parser.add_argument("--pipeline", default="", help="staging,portal workers of the pipeline, e.g. 4,8, off when missing")
+    parser.add_argument("--max-projects", type=int, default=3, help="max_projects of the project cache")
+    parser.add_argument("--chunked", type=float, default=0, help="enable chunked uploads with parts of this many MB")
+    parser.add_argument("--runs", type=int, default=1, help="consecutive runs against the same portal, a churn share of the data changes between runs")
+    parser.add_argument("--sim", action="append", default=[], metavar="KEY=VALUE", help="simulation setting, see bench/stubs/benchsim.py, can be repeated")
+    parser.add_argument("--start-method", choices=["fork", "spawn", "forkserver"], help="start method of the staging processes")
+    parser.add_argument("--output", help="append the result as one JSON line to this file")
+    parser.add_argument("--compare", help="print the results stored in this file as a table and exit")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch folder with the log, reports and staging files")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def parseSim(pairs):
+    sim = {}
+    for pair in pairs:
+        key, value = pair.split("=", 1)
+        try:
+            sim[key] = json.loads(value)
+        except ValueError:
+            sim[key] = value
+    return sim
+
+def gitCommit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--", "updateServices.py", "bench"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+        return commit, bool(dirty)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def buildScenario(args, workdir):
+    # Writes settings.config and the portal content it refers to into workdir
+    types = [t.strip().upper() for t in args.types.split(",") if t.strip()]
+    old = int((time() - 30 * 86400) * 1000)
+    config = {
+        "portal":"https://bench.invalid/portal",
+        "username":OWNER,
+        "password":"bench",
+        "encrypted":False,
+        "retrylimit":5,
+        "retry":{
+            "base_delay":0.1,
+            "max_delay":1,
+            "poll_timeout":60
+        },
+        "project_cache":{
+            "max_projects":args.max_projects
+        },
+        "services":[],
+        "tasks":[]
+    }
+    if args.pipeline and args.pipeline != "off":
+        staging_workers, portal_workers = [int(n) for n in args.pipeline.split(",")]
+        config["pipeline"] = {"enabled":True, "staging_workers":staging_workers, "portal_workers":portal_workers}
+    if args.chunked:
+        config["upload"] = {"chunk_mb":args.chunked, "workers":4}
+    portal = {"folders":{OWNER:[]}, "items":[]}
+
+    for i in range(args.services):
+        service_type = types[i % len(types)]
+        name = "Bench_{}_{}".format(service_type, str(i))
+        service = {
+            "name":name,
+            "project":os.path.join(workdir, "projects", "Project{}.aprx".format(str(i % max(1, args.projects)))),
+            "map":"Map_{}".format(str(i)),
+            "portalfolder":"",
+            "process":True,
+            "sharing":{"public":False, "org":True, "groups":[]},
+            "sync":{"frequency":"daily", "last":"2000-01-01"},
+            "type":service_type
+        }
+        if service_type in ["FEATURE", "UPSERT"]:
+            portal["items"].append({"title":name, "type":"Service Definition", "owner":OWNER, "created":old})
+            portal["items"].append({"title":name, "type":"Feature Service", "owner":OWNER, "created":old})
+        else:
+            service["id"] = "t{:031d}".format(i)
+            service["summary"] = "Benchmark layer {}".format(name)
+            service["tags"] = "bench"
+            portal["items"].append({"id":service["id"], "title":name, "type":"Vector Tile Service" if service_type == "REPLACEVECTORTILE" else "Map Service", "owner":OWNER, "created":old})
+        if service_type == "UPSERT":
+            service["parameters"] = {"key_field":"ASSET_ID"}
+        if service_type == "REPLACETILE":
+            service["parameters"] = {"aoi":"AOI", "aoi_selectors":[]}
+        config["services"].append(service)
+
+    if args.clean:
+        owner = OWNER if args.clean_owner else "cleanup"
+        for i in range(args.clean):
+            portal["items"].append({
+                "title":"{}{}".format(CLEAN_PREFIX, str(i)),
+                "type":"Vector Tile Package" if i % 2 else "Vector Tile Service",
+                "owner":owner,
+                "created":old - i * 60000
+            })
+        task = {
+            "summary":"Benchmark cleanup",
+            "type":"CLEAN",
+            "find":CLEAN_PREFIX,
+            "content_type":"Vector Tile",
+            "olderthan":7,
+            "process":True,
+            "sync":{"frequency":"daily", "last":"2000-01-01"},
+            "workers":args.clean_workers,
+            "batch_size":args.clean_batch
+        }
+        if args.clean_owner:
+            task["owner"] = owner
+        config["tasks"].append(task)
+
+    with open(os.path.join(workdir, "settings.config"), 'w') as f:
+        json.dump(config, f, indent=4)
+    with open(os.path.join(workdir, "portal.json"), 'w') as f:
+        json.dump(portal, f)
+
+def megabytes(value):
+    return round(value / 1048576.0, 2)
+
+def maxRss(who):
+    # Linux reports kilobytes, macOS bytes
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    return megabytes(rss if sys.platform == "darwin" else rss * 1024)
+
+def lastReport(workdir, known):
+    reports = os.path.join(workdir, "reports")
+    if not os.path.exists(reports):
+        return None
+    new = sorted(name for name in os.listdir(reports) if name not in known)
+    if not new:
+        return None
+    known.update(new)
+    with open(os.path.join(reports, new[-1]), 'r') as f:
+        lines = f.readlines()
+    return json.loads(lines[-1]) if lines else None
+
+def resetSync(configFile):
+    with open(configFile, 'r') as f:
+        config = json.load(f)
+    for entry in config["services"] + config["tasks"]:
+        entry["sync"]["last"] = "2000-01-01"
+    with open(configFile, 'w') as f:
+        json.dump(config, f, indent=4)
+
+def child(workdir):
+    # Runs in its own interpreter: updateServices.py keeps its files next to sys.path[0]
+    with open(os.path.join(workdir, "bench.json"), 'r') as f:
+        scenario = json.load(f)
+    sys.path[0] = workdir
+    sys.path.insert(1, STUBS)
+    sys.path.insert(2, ROOT)
+    if scenario["start_method"]:
+        import multiprocessing
+        multiprocessing.set_start_method(scenario["start_method"])
+    tracemalloc.start()
+    import benchsim
+    from arcgis.gis import portal
+    # The script is run as __main__ like a scheduled task would, so the benchmark also runs
+    # commits from before updateServices.py had a main()
+    script = os.path.join(ROOT, "updateServices.py")
+    sys.argv = [script]
+    configFile = os.path.join(workdir, "settings.config")
+    today = datetime.now().strftime("%Y-%m-%d")
+    reports = set()
+    runs = []
+
+    for run in range(scenario["runs"]):
+        benchsim.generation = run
+        calls = Counter(benchsim.calls)
+        uploaded = sum(benchsim.uploaded.values())
+        candidates = len(portal.search("title:{}".format(CLEAN_PREFIX)))
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        started = perf_counter()
+        try:
+            runpy.run_path(script, run_name="__main__")
+        except SystemExit:
+            pass
+        wall = perf_counter() - started
+
+        with open(configFile, 'r') as f:
+            config = json.load(f)
+        synced = len([service for service in config["services"] if service["sync"]["last"] == today])
+        deleted = candidates - len(portal.search("title:{}".format(CLEAN_PREFIX)))
+        made = benchsim.calls - calls
+        report = lastReport(workdir, reports)
+        errors = []
+        if deleted != candidates:
+            # Every CLEAN candidate of the scenario is old enough and can be deleted
+            errors.append("CLEAN deleted {} of {} candidates".format(str(deleted), str(candidates)))
+        runs.append({
+            "run":run + 1,
+            "wall_seconds":round(wall, 3),
+            "services":len(config["services"]),
+            "services_synced":synced,
+            "services_per_second":round(synced / wall, 3) if wall else None,
+            "clean_candidates":candidates,
+            "items_deleted":deleted,
+            "deletes_per_second":round(deleted / wall, 3) if wall else None,
+            "peak_traced_mb":megabytes(tracemalloc.get_traced_memory()[1]),
+            "max_rss_mb":maxRss(resource.RUSAGE_SELF) if resource else None,
+            "max_child_rss_mb":maxRss(resource.RUSAGE_CHILDREN) if resource else None,
+            "portal_calls":sum(made.values()),
+            "portal_calls_by_type":dict(sorted(made.items())),
+            "uploaded_mb":megabytes(sum(benchsim.uploaded.values()) - uploaded),
+            "stages":report["summary"]["stages"] if report else None,
+            "errors":errors
+        })
+        resetSync(configFile)
+
+    with open(os.path.join(workdir, "result.json"), 'w') as f:
+        json.dump(runs, f)
+
+def compare(path):
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                rows.append(json.loads(line))
+    header = "{:<10}{:<20}{:>5}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}{:>8}".format("commit", "label", "run", "wall s", "svc/s", "deletes/s", "calls", "peak MB", "rss MB", "errors")
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        commit = (row["commit"] or "unknown")[:8] + ("*" if row["dirty"] else "")
+        for run in row["runs"]:
+            print("{:<10}{:<20}{:>5}{:>10}{:>10}{:>12}{:>10}{:>10}{:>10}{:>8}".format(commit, row["label"][:19], str(run["run"]), str(run["wall_seconds"]), str(run["services_per_second"]), str(run["deletes_per_second"]), str(run["portal_calls"]), str(run["peak_traced_mb"]), str(run["max_rss_mb"]), str(len(run.get("errors", [])))))
+
+def main():
+    args = parseArgs()
+    if args.child:
+        child(args.child)
+        return
+    if args.compare:
+        compare(args.compare)
+        return
+
+    sim = parseSim(args.sim)
+    workdir = tempfile.mkdtemp(prefix="updateServices_bench_")
+    try:
+        buildScenario(args, workdir)
+        sim["portal_seed"] = os.path.join(workdir, "portal.json")
+        with open(os.path.join(workdir, "bench.json"), 'w') as f:
+            json.dump({"runs":max(1, args.runs), "start_method":args.start_method}, f)
+        env = dict(os.environ)
+        env["BENCH_SIM"] = json.dumps(sim)
+        started = datetime.now()
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--child", workdir], env=env)
+        with open(os.path.join(workdir, "result.json"), 'r') as f:
+            runs = json.load(f)
+    finally:
+        if args.keep:
+            print("Kept {}".format(workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit, dirty = gitCommit()
+    scenario = {key:value for key, value in vars(args).items() if key not in ["child", "compare", "output", "keep", "sim", "label"]}
+    sim.pop("portal_seed")
+    result = {
+        "commit":commit,
+        "dirty":dirty,
+        "label":args.label,
+        "started":started.isoformat(),
+        "python":platform.python_version(),
+        "platform":platform.platform(),
+        "scenario":scenario,
+        "sim":sim,
+        "runs":runs
+    }
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + "\n")
+    errors = ["Run {}: {}".format(str(run["run"]), error) for run in runs for error in run["errors"]]
+    for error in errors:
+        print("[ERROR] {}".format(error), file=sys.stderr)
+    if errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
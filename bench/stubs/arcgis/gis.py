@@ -0,0 +1,226 @@
+# Stand-in for arcgis.gis.GIS backed by an in-memory portal. Every request is counted by
+# name in benchsim.calls, delayed by request_seconds (plus the upload time or the publish,
+# replace and search delays) and fails with a dropped connection at failure_rate.
+import os
+import re
+import json
+import threading
+from time import time
+from types import SimpleNamespace
+
+import benchsim
+
+class FeatureLayer:
+    def __init__(self, name):
+        self.properties = SimpleNamespace(name=name, objectIdField="OBJECTID")
+
+    def query(self, where="1=1", out_fields="*", return_geometry=True, return_all_records=True, **kwargs):
+        benchsim.request("query")
+        key_field = out_fields.split(",")[0]
+        features = [SimpleNamespace(attributes={key_field:"K{}".format(str(i)), "OBJECTID":i + 1}) for i in range(benchsim.settings["rows"])]
+        return SimpleNamespace(features=features)
+
+    def edit_features(self, adds=None, updates=None, deletes=None, **kwargs):
+        benchsim.request("apply edits")
+        deleted = deletes.split(",") if isinstance(deletes, str) else (deletes or [])
+        return {
+            "addResults":[{"success":True} for feature in adds or []],
+            "updateResults":[{"success":True} for feature in updates or []],
+            "deleteResults":[{"success":True} for oid in deleted]
+        }
+
+class Item:
+    def __init__(self, portal, itemid, title, item_type, owner, folder=None, created=None):
+        self.portal = portal
+        self.id = itemid
+        self.title = title
+        self.type = item_type
+        self.owner = owner
+        self.ownerFolder = folder
+        self.created = created or int(time() * 1000)
+        self.modified = self.created
+        self.can_delete = True
+        self.polls = benchsim.settings["ready_polls"]
+
+    @property
+    def layers(self):
+        names = ["Layer{}".format(str(i)) for i in range(benchsim.settings["layers"])] + ["AOI"]
+        return [FeatureLayer(name) for name in names]
+
+    def update(self, item_properties=None, data=None, **kwargs):
+        if data:
+            benchsim.transfer("update", data)
+        else:
+            benchsim.request("update")
+        self.modified = int(time() * 1000)
+        return True
+
+    def publish(self, publish_parameters=None, overwrite=False, **kwargs):
+        benchsim.request("publish", benchsim.settings["publish_seconds"])
+        return self.portal.publish(self, overwrite)
+
+    def share(self, everyone=False, org=False, groups=None, **kwargs):
+        benchsim.request("share")
+        return {"results":[]}
+
+    def status(self, job_id=None, job_type=None):
+        benchsim.request("status")
+        if self.polls > 0:
+            self.polls -= 1
+            return {"status":"processing"}
+        return {"status":"completed"}
+
+    def delete(self, force=False, dry_run=False):
+        benchsim.request("delete")
+        if dry_run:
+            return {"can_delete":True, "details":{}}
+        self.portal.remove(self.id)
+        return True
+
+class Portal:
+    # The content of the simulated portal, seeded from the portal.json written by bench/run.py
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+        self.folders = {}
+        self.next = 0
+        seed = benchsim.settings.get("portal_seed")
+        if seed and os.path.exists(seed):
+            with open(seed, 'r') as f:
+                content = json.load(f)
+            for owner, folders in content["folders"].items():
+                self.folders[owner] = folders
+            for entry in content["items"]:
+                self.create(entry["title"], entry["type"], entry["owner"], entry.get("folder"), entry.get("created"), entry.get("id"))
+
+    def create(self, title, item_type, owner, folder=None, created=None, itemid=None):
+        with self.lock:
+            if itemid is None:
+                self.next += 1
+                itemid = "{:032x}".format(self.next)
+            item = Item(self, itemid, title, item_type, owner, folder, created)
+            self.items[itemid] = item
+        return item
+
+    def remove(self, itemid):
+        with self.lock:
+            self.items.pop(itemid, None)
+
+    def get(self, itemid):
+        with self.lock:
+            return self.items.get(itemid)
+
+    def publish(self, item, overwrite):
+        if item.type == "Service Definition":
+            with self.lock:
+                existing = [other for other in self.items.values() if other.title == item.title and other.type == "Feature Service"]
+            if overwrite and existing:
+                return existing[0]
+            return self.create(item.title, "Feature Service", item.owner, item.ownerFolder)
+        service_type = "Vector Tile Service" if item.type == "Vector Tile Package" else "Map Service"
+        return self.create(item.title, service_type, item.owner, item.ownerFolder)
+
+    def sharePackage(self, path, owner, title):
+        benchsim.transfer("share package", path)
+        benchsim.wait(benchsim.settings["publish_seconds"])
+        package = self.create(title, "Vector Tile Package" if path.endswith(".vtpk") else "Compact Tile Package", owner)
+        return package, self.publish(package, False)
+
+    def search(self, query):
+        # owner:, title:, type: and created:/modified: ranges, titles match loosely like the
+        # full text search of a real portal. Words outside of a field, other than AND, OR and
+        # NOT, have to be one of the words of the title.
+        fields = r'(\w+):(\[[^\]]*\]|.*?)(?=\s+\w+:|\s+AND\s|$)'
+        terms = dict((key, value.strip()) for key, value in re.findall(fields, query))
+        words = [word for word in re.sub(fields, "", query).split() if word not in ["AND", "OR", "NOT"]]
+        with self.lock:
+            items = list(self.items.values())
+        for word in words:
+            items = [item for item in items if word.lower() in item.title.lower().split()]
+        if "owner" in terms:
+            items = [item for item in items if item.owner == terms["owner"]]
+        if "title" in terms:
+            items = [item for item in items if terms["title"].lower() in item.title.lower()]
+        if "type" in terms:
+            items = [item for item in items if item.type.startswith(terms["type"])]
+        for field in ["created", "modified"]:
+            if field in terms:
+                lower, upper = [int(bound) for bound in terms[field].strip("[]").split(" TO ")]
+                items = [item for item in items if lower <= getattr(item, field) <= upper]
+        return items
+
+portal = Portal()
+
+class ContentManager:
+    def get(self, itemid):
+        benchsim.request("get")
+        return portal.get(itemid)
+
+    def search(self, query, item_type=None, sort_field="avgRating", sort_order="desc", max_items=10, outside_org=False, **kwargs):
+        benchsim.request("search", benchsim.settings["search_seconds"])
+        items = portal.search(query)
+        if item_type:
+            items = [item for item in items if item.type == item_type]
+        if sort_field in ["title", "created", "modified"]:
+            items = sorted(items, key=lambda item: getattr(item, sort_field), reverse=sort_order == "desc")
+        return items if max_items < 0 else items[:max_items]
+
+    def advanced_search(self, query, max_items=100, start=1, sort_field="title", sort_order="asc", **kwargs):
+        benchsim.request("search", benchsim.settings["search_seconds"])
+        items = sorted(portal.search(query), key=lambda item: getattr(item, sort_field), reverse=sort_order == "desc")
+        size = min(max_items, benchsim.settings["page_size"])
+        page = items[start - 1:start - 1 + size]
+        following = start + len(page)
+        return {"total":len(items), "start":start, "num":len(page), "nextStart":following if following <= len(items) else -1, "results":page}
+
+    def add(self, item_properties, data=None, folder=None, **kwargs):
+        benchsim.transfer("add", data)
+        return portal.create(item_properties["title"], item_properties["type"], "bench", folder)
+
+    def replace_service(self, replace_item, new_item, replace_metadata=False, **kwargs):
+        benchsim.request("replace", benchsim.settings["replace_seconds"])
+        return True
+
+    def delete_items(self, items):
+        benchsim.request("delete items")
+        for item in items:
+            portal.remove(item.id)
+        return True
+
+class UserManager:
+    def get(self, username):
+        benchsim.request("user")
+        folders = portal.folders.get(username, [])
+        return SimpleNamespace(username=username, folders=folders)
+
+    @property
+    def me(self):
+        benchsim.request("me")
+        return SimpleNamespace(username="bench")
+
+class Connection:
+    # Just the multipart item upload of the sharing REST API
+    def post(self, url, params, files=None):
+        match = re.search(r'/content/users/([^/]+)/(.*)$', url)
+        owner, path = match.group(1), match.group(2)
+        operation = path.rsplit("/", 1)[-1]
+        if operation == "addPart":
+            benchsim.transfer("addPart", files["file"])
+            return {"success":True}
+        benchsim.request(operation)
+        if operation == "addItem":
+            folder = path.split("/")[0] if "/" in path else None
+            item = portal.create(params.get("title", params.get("filename")), params.get("type", ""), owner, folder)
+            return {"success":True, "id":item.id}
+        if operation == "status":
+            return {"status":"completed"}
+        return {"success":True}
+
+class GIS:
+    def __init__(self, url=None, username=None, password=None, **kwargs):
+        benchsim.request("sign in")
+        self.url = url
+        self.content = ContentManager()
+        self.users = UserManager()
+        self._con = Connection()
+        self._portal = SimpleNamespace(resturl="{}/sharing/rest/".format((url or "https://bench.invalid").rstrip("/")))
@@ -0,0 +1,185 @@
+# Stand-in for the parts of arcpy that updateServices.py uses. Projects, maps and layers are
+# made up from their names, geoprocessing tools sleep for their configured time and write
+# files of the configured size.
+import os
+import json
+import fnmatch
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import benchsim
+
+env = SimpleNamespace(overwriteOutput=False)
+
+class Layer:
+    def __init__(self, mapname, name, source):
+        self.name = name
+        self.longName = "{}\\{}".format(mapname, name)
+        self.dataSource = source
+        self.isFeatureLayer = True
+
+    def supports(self, prop):
+        return True
+
+    def getDefinition(self, version):
+        return {"name":self.name, "renderer":{"type":"simple"}}
+
+class Table:
+    def __init__(self, mapname, name, source):
+        self.name = name
+        self.longName = "{}\\{}".format(mapname, name)
+        self.dataSource = source
+        self.isBroken = False
+
+    def getDefinition(self, version):
+        return {"name":self.name}
+
+class Draft:
+    def __init__(self, name):
+        self.name = name
+
+    def exportToSDDraft(self, path):
+        benchsim.wait(benchsim.settings["draft_seconds"])
+        with open(path, 'w') as f:
+            f.write("<SVCManifest><Name>{}</Name></SVCManifest>".format(self.name))
+
+class Map:
+    def __init__(self, project, name):
+        self.name = name
+        self.spatialReference = SimpleNamespace(factoryCode=3857)
+        folder = os.path.splitext(project)[0]
+        self.layers = [Layer(name, "Layer{}".format(str(i)), "{}\\{}\\Layer{}".format(folder, name, str(i))) for i in range(benchsim.settings["layers"])]
+        self.layers.append(Layer(name, "AOI", "{}\\{}\\AOI".format(folder, name)))
+        self.tables = [Table(name, "Table{}".format(str(i)), "{}\\{}\\Table{}".format(folder, name, str(i))) for i in range(benchsim.settings["tables"])]
+
+    def listLayers(self, wildcard=None):
+        return [layer for layer in self.layers if wildcard is None or fnmatch.fnmatch(layer.name, wildcard)]
+
+    def listTables(self, wildcard=None):
+        return [table for table in self.tables if wildcard is None or fnmatch.fnmatch(table.name, wildcard)]
+
+    def clearSelection(self):
+        pass
+
+    def getWebLayerSharingDraft(self, server_type, service_type, service_name):
+        benchsim.crash(service_name)
+        return Draft(service_name)
+
+class ArcGISProject:
+    def __init__(self, path):
+        benchsim.wait(benchsim.settings["project_seconds"])
+        self.filePath = path
+        self.maps = {}
+
+    def listMaps(self, wildcard=None):
+        if wildcard not in self.maps:
+            self.maps[wildcard] = Map(self.filePath, wildcard)
+        return [self.maps[wildcard]]
+
+mp = SimpleNamespace(ArcGISProject=ArcGISProject)
+
+FIELDS = [
+    SimpleNamespace(name="OBJECTID", type="OID", length=4, editable=False),
+    SimpleNamespace(name="ASSET_ID", type="String", length=32, editable=True),
+    SimpleNamespace(name="VALUE", type="Integer", length=4, editable=True),
+    SimpleNamespace(name="last_edited_date", type="Date", length=8, editable=False),
+    SimpleNamespace(name="Shape", type="Geometry", length=0, editable=True)
+]
+
+def Describe(source):
+    return SimpleNamespace(
+        editorTrackingEnabled=True,
+        creatorFieldName="",
+        createdAtFieldName="",
+        editorFieldName="",
+        editedAtFieldName="last_edited_date",
+        shapeFieldName="Shape",
+        fields=FIELDS
+    )
+
+class Geometry:
+    def __init__(self, source):
+        self.source = source
+
+    def union(self, other):
+        return self
+
+class SearchCursor:
+    def __init__(self, source, fields, where_clause=None, spatial_reference=None, sql_clause=None):
+        self.source = getattr(source, "dataSource", source)
+        self.fields = fields
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __iter__(self):
+        churned = benchsim.isChurned(self.source)
+        edited = datetime(2024, 1, 1) + timedelta(days=benchsim.generation if churned else 0)
+        if self.fields == ["SHAPE@"]:
+            yield (Geometry(self.source),)
+            return
+        if self.fields == ["last_edited_date"]:
+            yield (edited,)
+            return
+        for i in range(benchsim.settings["rows"]):
+            row = []
+            for field in self.fields:
+                if field == "ASSET_ID":
+                    row.append("K{}".format(str(i)))
+                elif field == "VALUE":
+                    # A tenth of the rows of a churned source change
+                    row.append(i + (benchsim.generation if churned and i % 10 == 0 else 0))
+                elif field == "last_edited_date":
+                    row.append(edited)
+                elif field == "SHAPE@JSON":
+                    row.append(json.dumps({"x":float(i), "y":float(i)}))
+                elif field == "SHAPE@WKB":
+                    row.append(bytes(21))
+                else:
+                    row.append(None)
+            yield tuple(row)
+
+da = SimpleNamespace(SearchCursor=SearchCursor)
+
+def GetCount(source):
+    return [str(benchsim.settings["rows"])]
+
+def SelectLayerByLocation(*args, **kwargs):
+    return None
+
+def CreateVectorTilePackage(mapview, path, *args, **kwargs):
+    benchsim.wait(benchsim.settings["packaging_seconds"])
+    benchsim.writeFile(path, benchsim.settings["package_mb"])
+
+def CreateMapTilePackage(mapview, service_type, path, *args, **kwargs):
+    benchsim.wait(benchsim.settings["packaging_seconds"])
+    benchsim.writeFile(path, benchsim.settings["package_mb"])
+
+def Delete(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def SharePackage(path, username, password, summary=None, tags=None, **kwargs):
+    # Uploads and publishes in one tool, it talks to the same simulated portal as arcgis.gis
+    from arcgis.gis import portal
+    package, service = portal.sharePackage(path, username, os.path.splitext(os.path.basename(path))[0])
+    return [None, json.dumps({"publishResult":{"serviceItemId":service.id}}), package.id]
+
+management = SimpleNamespace(
+    GetCount=GetCount,
+    SelectLayerByLocation=SelectLayerByLocation,
+    CreateVectorTilePackage=CreateVectorTilePackage,
+    CreateMapTilePackage=CreateMapTilePackage,
+    Delete=Delete,
+    SharePackage=SharePackage
+)
+
+def StageService_server(sddraft, sd):
+    benchsim.wait(benchsim.settings["staging_seconds"])
+    benchsim.writeFile(sd, benchsim.settings["sd_mb"])
+
+def GetMessages(severity=0):
+    return ""
@@ -0,0 +1,93 @@
+import os
+import json
+import random
+import threading
+from time import sleep, monotonic
+from collections import Counter
+
+# Settings of the simulated ArcGIS Pro install and portal, passed by bench/run.py in the
+# BENCH_SIM environment variable so forked and spawned staging workers see the same values.
+# Durations are in seconds and multiplied by time_scale, sizes are in MB.
+DEFAULTS = {
+    "time_scale":1.0,
+    "seed":1,
+    "project_seconds":0.2,
+    "draft_seconds":0.05,
+    "staging_seconds":0.3,
+    "packaging_seconds":1.0,
+    "sd_mb":2,
+    "package_mb":10,
+    "layers":3,
+    "tables":0,
+    "rows":200,
+    "churn":0.1,
+    "request_seconds":0.03,
+    "upload_mb_per_s":20,
+    "link_mb_per_s":50,
+    "publish_seconds":0.5,
+    "replace_seconds":0.3,
+    "ready_polls":0,
+    "page_size":100,
+    "search_seconds":0.1,
+    "failure_rate":0.0,
+    "crash_services":[]
+}
+
+settings = dict(DEFAULTS)
+settings.update(json.loads(os.environ.get("BENCH_SIM", "{}")))
+
+# Run number of the benchmark, bumped between runs so a churn share of the data changes
+generation = 0
+
+calls = Counter()
+uploaded = Counter()
+lock = threading.Lock()
+failures = random.Random(settings["seed"])
+link = {"free":0.0}
+
+def wait(seconds):
+    if seconds > 0:
+        sleep(seconds * settings["time_scale"])
+
+def request(name, seconds=0.0):
+    # One round trip to the portal: counted, delayed and sometimes failed like a dropped connection
+    with lock:
+        calls[name] += 1
+        fail = failures.random() < settings["failure_rate"]
+    wait(settings["request_seconds"] + seconds)
+    if fail:
+        raise ConnectionError("Simulated connection reset during {}".format(name))
+
+def crash(service_name):
+    # Ends the process without cleanup like an access violation inside arcpy
+    if service_name in settings["crash_services"]:
+        os._exit(3)
+
+def transfer(name, path):
+    # Uploads share one link of link_mb_per_s and each runs at most at upload_mb_per_s
+    size = os.path.getsize(path)
+    megabytes = size / 1048576.0
+    seconds = megabytes / settings["upload_mb_per_s"] if settings["upload_mb_per_s"] else 0.0
+    if settings["link_mb_per_s"]:
+        with lock:
+            now = monotonic()
+            start = max(now, link["free"])
+            link["free"] = start + megabytes / settings["link_mb_per_s"] * settings["time_scale"]
+            queued = (link["free"] - now) / settings["time_scale"]
+        seconds = max(seconds, queued)
+    with lock:
+        uploaded[name] += size
+    request(name, seconds)
+
+def isChurned(source):
+    # Stable per source and run, roughly a churn share of the sources change every run
+    if generation == 0:
+        return False
+    return random.Random("{}:{}".format(source, generation)).random() < settings["churn"]
+
+def writeFile(path, megabytes):
+    # Sparse files, the size is what the upload and hashing see without filling the disk. The
+    # header makes every file unique like a real package, which embeds build times and ids.
+    with open(path, 'wb') as f:
+        f.write("{}:{}:{}".format(os.path.basename(path), str(generation), os.urandom(8).hex()).encode("utf-8"))
+        f.truncate(int(megabytes * 1048576))
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# The tests run updateServices.py against the stand-ins for arcpy and arcgis.gis used by the
+# benchmark, see bench/stubs
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, "bench", "stubs"))
+
+import benchsim
+import updateServices
+
+benchsim.settings["time_scale"] = 0
+benchsim.settings["link_mb_per_s"] = 0
+
+@pytest.fixture(autouse=True)
+def logfile(tmp_path, monkeypatch):
+    monkeypatch.setattr(updateServices.Log, "logfile", str(tmp_path / "services.log"))
+    yield tmp_path / "services.log"
+    updateServices.Log.flush()
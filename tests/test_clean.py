@@ -0,0 +1,47 @@
+from time import time
+
+import pytest
+
+import benchsim
+import updateServices
+from arcgis.gis import GIS, portal
+
+PREFIX = "VT_Test_"
+
+@pytest.fixture
+def candidates():
+    old = int((time() - 30 * 86400) * 1000)
+    items = [portal.create("{}{}".format(PREFIX, str(i)), "Vector Tile Package", "cleanup", created=old + i // 2) for i in range(250)]
+    yield items
+    for item in items:
+        portal.remove(item.id)
+
+def remaining():
+    return [item for item in portal.search("title:{}".format(PREFIX))]
+
+@pytest.mark.parametrize("workers, batch_size, page_size", [(1, 1, 100), (4, 10, 100), (4, 10, 7), (2, 1, 3)])
+def test_clean_deletes_every_candidate_in_one_run(candidates, monkeypatch, workers, batch_size, page_size):
+    # Deletes made while paging must not shift later pages past unseen candidates
+    monkeypatch.setitem(benchsim.settings, "page_size", page_size)
+    task = {"summary":"Test cleanup", "find":PREFIX, "content_type":"Vector Tile", "olderthan":7, "workers":workers, "batch_size":batch_size}
+    found, deleted = updateServices.cleanItems(GIS(), task, {})
+    assert found == len(candidates)
+    assert deleted == len(candidates)
+    assert remaining() == []
+
+def test_dry_run_returns_every_candidate_once(candidates, monkeypatch):
+    monkeypatch.setitem(benchsim.settings, "page_size", 7)
+    task = {"summary":"Test cleanup", "find":PREFIX, "olderthan":7, "dry_run":True}
+    found, deleted = updateServices.cleanItems(GIS(), task, {})
+    assert found == deleted == len(candidates)
+    assert len(remaining()) == len(candidates)
+
+def test_search_pages_through_items_created_in_the_same_millisecond(monkeypatch):
+    monkeypatch.setitem(benchsim.settings, "page_size", 5)
+    items = [portal.create("{}{}".format(PREFIX, str(i)), "Vector Tile Package", "cleanup", created=1000) for i in range(12)]
+    try:
+        found = [item.id for item in updateServices.searchItems(GIS(), "title:{}".format(PREFIX), page_size=5)]
+    finally:
+        for item in items:
+            portal.remove(item.id)
+    assert sorted(found) == sorted(item.id for item in items)
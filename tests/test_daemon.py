@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+import updateServices
+
+class Stop(Exception):
+    pass
+
+def test_failed_run_is_queued_again(tmp_path, monkeypatch, logfile):
+    service = {"name":"Daemon_Test", "process":True, "type":"FEATURE", "sync":{"frequency":"daily", "last":"2000-01-01"}}
+    configFile = tmp_path / "settings.config"
+    configFile.write_text(json.dumps({"portal":"", "username":"", "password":"", "encrypted":True, "services":[service], "daemon":{"retry_minutes":5}}))
+    runs = []
+    def runJobs(session, config, services, tasks):
+        runs.append([service["name"] for service in services])
+        raise OSError("simulated failure")
+    waits = []
+    def sleep(seconds):
+        waits.append(seconds)
+        raise Stop()
+    monkeypatch.setattr(updateServices, "runJobs", runJobs)
+    monkeypatch.setattr(updateServices, "sleep", sleep)
+    with pytest.raises(Stop):
+        updateServices.runDaemon(str(configFile))
+    updateServices.Log.flush()
+    assert runs == [["Daemon_Test"]]
+    # The daemon kept going and waits for the retry instead of running the job again at once
+    assert waits
+    assert "Failed to run the due jobs, they are retried in 5 minutes" in logfile.read_text()
+
+def test_retry_stats_are_reported_per_run(logfile):
+    policy = updateServices.RetryPolicy()
+    policy.record("upload", 2, 1.5)
+    policy.report()
+    policy.report()
+    updateServices.Log.flush()
+    assert logfile.read_text().count("upload: 1 calls") == 1
+
+def daemonConfig(tmp_path, services):
+    configFile = tmp_path / "settings.config"
+    configFile.write_text(json.dumps({"portal":"", "username":"", "password":"", "encrypted":True, "services":services, "daemon":{"retry_minutes":5}}))
+    return configFile
+
+def dailyService(name, last="2000-01-01"):
+    return {"name":name, "process":True, "type":"FEATURE", "sync":{"frequency":"daily", "last":last}}
+
+def test_edits_made_during_a_run_are_kept(tmp_path, monkeypatch):
+    configFile = daemonConfig(tmp_path, [dailyService("Daemon_A")])
+    def runJobs(session, config, services, tasks):
+        # Someone edits the file while the services run
+        edited = json.loads(configFile.read_text())
+        edited["services"].append(dailyService("Daemon_B", "2999-01-01"))
+        edited["services"][0]["force"] = True
+        configFile.write_text(json.dumps(edited))
+        for service in services:
+            updateServices.markSynced(service)
+    def sleep(seconds):
+        raise Stop()
+    monkeypatch.setattr(updateServices, "runJobs", runJobs)
+    monkeypatch.setattr(updateServices, "sleep", sleep)
+    with pytest.raises(Stop):
+        updateServices.runDaemon(str(configFile))
+    saved = json.loads(configFile.read_text())
+    assert [service["name"] for service in saved["services"]] == ["Daemon_A", "Daemon_B"]
+    assert saved["services"][0]["force"] is True
+    assert saved["services"][0]["sync"]["last"] != "2000-01-01"
+
+def test_services_added_while_waiting_are_run(tmp_path, monkeypatch):
+    configFile = daemonConfig(tmp_path, [dailyService("Daemon_A", "2999-01-01")])
+    runs = []
+    def runJobs(session, config, services, tasks):
+        runs.append([service["name"] for service in services])
+        for service in services:
+            updateServices.markSynced(service)
+    waits = []
+    def sleep(seconds):
+        waits.append(seconds)
+        if len(waits) > 1:
+            raise Stop()
+        edited = json.loads(configFile.read_text())
+        edited["services"].append(dailyService("Daemon_B"))
+        configFile.write_text(json.dumps(edited))
+    monkeypatch.setattr(updateServices, "runJobs", runJobs)
+    monkeypatch.setattr(updateServices, "sleep", sleep)
+    with pytest.raises(Stop):
+        updateServices.runDaemon(str(configFile))
+    assert runs == [["Daemon_B"]]
+
+def test_a_job_waiting_for_a_retry_keeps_its_place_after_a_reload(tmp_path, monkeypatch):
+    configFile = daemonConfig(tmp_path, [dailyService("Daemon_A")])
+    runs = []
+    def runJobs(session, config, services, tasks):
+        runs.append([service["name"] for service in services])
+    waits = []
+    def sleep(seconds):
+        waits.append(seconds)
+        if len(waits) > 2:
+            raise Stop()
+        edited = json.loads(configFile.read_text())
+        edited["daemon"]["poll_seconds"] = 30
+        configFile.write_text(json.dumps(edited))
+    monkeypatch.setattr(updateServices, "runJobs", runJobs)
+    monkeypatch.setattr(updateServices, "sleep", sleep)
+    with pytest.raises(Stop):
+        updateServices.runDaemon(str(configFile))
+    # Daemon_A failed, the reloads don't run it again before retry_minutes
+    assert runs == [["Daemon_A"]]
+    assert waits[1:] == [30, 30]
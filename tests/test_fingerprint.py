@@ -0,0 +1,55 @@
+import pytest
+
+import updateServices
+
+@pytest.fixture
+def fingerprint(tmp_path, monkeypatch):
+    # Fingerprints a map of the stand-in arcpy with two layers and a standalone table
+    import arcpy
+    import benchsim
+    monkeypatch.setattr(updateServices, "arcpy", arcpy)
+    monkeypatch.setitem(benchsim.settings, "layers", 2)
+    monkeypatch.setitem(benchsim.settings, "tables", 1)
+    service = {"name":"Fingerprint_Test", "type":"FEATURE", "sync":{"frequency":"daily", "last":"2000-01-01"}}
+    mapview = arcpy.mp.ArcGISProject(str(tmp_path / "Project.aprx")).listMaps("Map")[0]
+    def check(previous):
+        result = {"unchanged":False, "fingerprint":None, "definition":None, "counts":{}}
+        skipped = updateServices.checkFingerprint(service, mapview, result, previous)
+        return skipped, result
+    published = check(None)[1]
+    return check, published, service, benchsim
+
+def test_unchanged_service_is_skipped(fingerprint, logfile):
+    check, published, service, benchsim = fingerprint
+    skipped, result = check(published)
+    assert skipped and result["unchanged"]
+    updateServices.Log.flush()
+    assert "[SKIP] unchanged, Fingerprint_Test" in logfile.read_text()
+
+def test_force_publishes_an_unchanged_service(fingerprint):
+    check, published, service, benchsim = fingerprint
+    service["force"] = True
+    skipped, result = check(published)
+    assert not skipped and not result["unchanged"]
+    # force isn't part of the fingerprint, the next run without it is skipped again
+    assert result["fingerprint"] == published["fingerprint"]
+
+def test_sync_dates_are_not_part_of_the_fingerprint(fingerprint):
+    check, published, service, benchsim = fingerprint
+    service["sync"]["last"] = "2024-01-01"
+    assert check(published)[0]
+
+def test_changed_table_rows_are_published(fingerprint, monkeypatch):
+    check, published, service, benchsim = fingerprint
+    monkeypatch.setattr(benchsim, "generation", 1)
+    monkeypatch.setattr(benchsim, "isChurned", lambda source: source.endswith("Table0"))
+    skipped, result = check(published)
+    assert not skipped
+    assert result["definition"] == published["definition"]
+
+def test_changed_service_settings_are_published(fingerprint):
+    check, published, service, benchsim = fingerprint
+    service["summary"] = "New summary"
+    skipped, result = check(published)
+    assert not skipped
+    assert result["definition"] != published["definition"]
@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import updateServices
+
+class Area:
+    # Records the footprints that make up the changed area
+    def __init__(self, extents):
+        self.extents = extents
+
+    def union(self, other):
+        return Area(self.extents + other.extents)
+
+def extent(*bounds, spatial_reference=None):
+    return SimpleNamespace(polygon=Area([list(bounds)]))
+
+def changedArea(monkeypatch, footprints, edits, previous):
+    monkeypatch.setattr(updateServices, "arcpy", SimpleNamespace(Extent=extent))
+    area = updateServices.getChangedArea(None, footprints, edits, previous)
+    return area if area in [None, False] else sorted(area.extents)
+
+def test_moved_feature_changes_its_old_and_new_location(monkeypatch):
+    previous = {"roads":{"1":[0, 0, 1, 1], "2":[5, 5, 6, 6]}}
+    footprints = {"roads":{"1":[10, 10, 11, 11], "2":[5, 5, 6, 6]}}
+    assert changedArea(monkeypatch, footprints, {"roads":["1"]}, previous) == [[0, 0, 1, 1], [10, 10, 11, 11]]
+
+def test_delete_and_insert_with_unchanged_count(monkeypatch):
+    # The row count is the same, the deleted feature still has to be removed from the tiles
+    previous = {"roads":{"1":[0, 0, 1, 1], "2":[5, 5, 6, 6]}}
+    footprints = {"roads":{"2":[5, 5, 6, 6], "3":[20, 20, 21, 21]}}
+    assert changedArea(monkeypatch, footprints, {"roads":["3"]}, previous) == [[0, 0, 1, 1], [20, 20, 21, 21]]
+
+def test_unchanged_features_leave_no_area(monkeypatch):
+    previous = {"roads":{"1":[0, 0, 1, 1]}}
+    assert changedArea(monkeypatch, {"roads":{"1":[0, 0, 1, 1]}}, {"roads":[]}, previous) is None
+
+def test_new_layer_needs_a_rebuild(monkeypatch):
+    previous = {"roads":{"1":[0, 0, 1, 1]}}
+    footprints = {"roads":{"1":[0, 0, 1, 1]}, "parcels":{"1":[2, 2, 3, 3]}}
+    assert changedArea(monkeypatch, footprints, {"roads":[], "parcels":[]}, previous) is False
@@ -0,0 +1,88 @@
+import sys
+
+import pytest
+
+import benchsim
+import updateServices
+from arcgis.gis import GIS, portal
+
+OWNER = "indexer"
+
+@pytest.fixture
+def content(monkeypatch):
+    monkeypatch.setitem(portal.folders, OWNER, [{"title":"Basemaps", "id":"f1"}])
+    items = [
+        portal.create("Roads", "Service Definition", OWNER, created=1),
+        portal.create("Roads", "Feature Service", OWNER, created=2),
+        portal.create("Roads Centerlines", "Service Definition", OWNER, created=3),
+        portal.create("VT_Roads_2", "Vector Tile Package", OWNER, "f1", created=5),
+        portal.create("VT_Roads_1", "Vector Tile Service", OWNER, "f1", created=4),
+        portal.create("VT_Roads_3", "Vector Tile Package", OWNER, created=6),
+        portal.create("VT_Roads_4", "Feature Service", OWNER, "f1", created=7),
+        portal.create("Roads", "Service Definition", "someone else", created=8)
+    ]
+    yield updateServices.ContentIndex(GIS(), OWNER).build(), items
+    for item in items:
+        portal.remove(item.id)
+
+def test_find_matches_titles_exactly(content):
+    index, items = content
+    assert index.find(title="Roads", item_type="Service Definition") == [items[0]]
+    assert sorted(item.id for item in index.find(title="Roads")) == sorted([items[0].id, items[1].id])
+    assert index.find(title="Road") == []
+
+def test_find_by_folder_title_or_id(content):
+    index, items = content
+    assert sorted(item.title for item in index.find(folder="Basemaps")) == ["VT_Roads_1", "VT_Roads_2", "VT_Roads_4"]
+    assert index.find(title="VT_Roads_2", folder="f1") == [items[3]]
+    assert index.find(title="VT_Roads_3", folder="Basemaps") == []
+
+def test_match_takes_a_title_prefix_and_a_type_prefix(content):
+    index, items = content
+    # Vector Tile covers the packages and services but not the feature service, oldest first
+    assert [item.title for item in index.match("VT_Roads_", "Vector Tile")] == ["VT_Roads_1", "VT_Roads_2", "VT_Roads_3"]
+    assert [item.title for item in index.match("VT_Roads_", "Vector Tile Package", "Basemaps")] == ["VT_Roads_2"]
+    assert [item.title for item in index.match("VT_Roads_")] == ["VT_Roads_1", "VT_Roads_2", "VT_Roads_3", "VT_Roads_4"]
+
+def test_index_follows_publishes_and_deletes(content):
+    index, items = content
+    created = portal.create("Parcels", "Feature Service", OWNER)
+    try:
+        index.add(created)
+        assert index.find(title="Parcels") == [created]
+    finally:
+        portal.remove(created.id)
+    assert index.refresh(created.id) is None
+    assert index.find(title="Parcels") == []
+
+def test_building_the_index_retries_dropped_connections(content, monkeypatch):
+    policy = updateServices.RetryPolicy()
+    policy.configure(limit=3, base_delay=0, max_delay=0)
+    monkeypatch.setattr(updateServices, "retrypolicy", policy)
+    failures = {"user":1, "search":1}
+    request = benchsim.request
+    def flaky(name, seconds=0.0):
+        if failures.get(name):
+            failures[name] -= 1
+            raise ConnectionError("Simulated connection reset during {}".format(name))
+        return request(name, seconds)
+    monkeypatch.setattr(benchsim, "request", flaky)
+    index = updateServices.ContentIndex(GIS(), OWNER).build()
+    assert len(index.find()) == len(content[1]) - 1
+    assert policy.stats["search"]["attempts"] == policy.stats["search"]["calls"] + 2
+
+def test_tasks_still_run_when_the_index_fails(tmp_path, monkeypatch):
+    import arcpy
+    ran = []
+    def getContentIndex(gis, owner, indexes):
+        raise ConnectionError("Simulated connection reset during search")
+    monkeypatch.setattr(updateServices, "arcpy", arcpy)
+    monkeypatch.setattr(updateServices, "getContentIndex", getContentIndex)
+    monkeypatch.setattr(updateServices, "processServices", lambda *args: ran.append("services"))
+    monkeypatch.setattr(updateServices, "runTasks", lambda gis, tasks, indexes: ran.append("tasks"))
+    monkeypatch.setattr(updateServices, "stagingcache", updateServices.StagingCache())
+    monkeypatch.setattr(sys, "path", [str(tmp_path)] + sys.path[1:])
+    session = type("Session", (), {"connect":lambda self: GIS()})()
+    config = {"username":OWNER, "password":"", "retrylimit":1}
+    updateServices.runJobs(session, config, [], [])
+    assert ran == ["tasks"]
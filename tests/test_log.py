@@ -0,0 +1,15 @@
+import updateServices
+from updateServices import Log
+
+def test_fail_lines_are_written_at_once(logfile):
+    Log("[INFO] buffered")
+    assert not logfile.exists()
+    Log("[FAIL] written")
+    assert logfile.read_text().splitlines()[-1].endswith("[FAIL] written")
+
+def test_workers_drop_the_lines_they_inherit(logfile, monkeypatch):
+    monkeypatch.setattr(updateServices, "initProjectCache", lambda settings: None)
+    Log("[INFO] logged by the parent before the fork")
+    updateServices.initWorker({})
+    Log.flush()
+    assert not logfile.exists()
@@ -0,0 +1,85 @@
+import multiprocessing
+
+import pytest
+
+import updateServices
+
+def makeServices(names, project="Project.aprx"):
+    return [{"name":name, "type":"FEATURE", "process":True, "project":project, "sync":{"frequency":"daily", "last":"2000-01-01"}} for name in names]
+
+def staged(service):
+    return {"name":service["name"], "staged":True, "unchanged":False, "fingerprint":None, "definition":None, "counts":{}, "footprints":None, "pending":None, "hash":None, "path":None}
+
+@pytest.fixture
+def portal(monkeypatch):
+    # Stages every service in the calling process and records the ones that were published
+    published = []
+    def stageService(service, staging, previous=None):
+        if service["name"].startswith("Broken"):
+            raise RuntimeError("simulated staging error")
+        return staged(service)
+    def publishService(gis, service, staged, username, password, index):
+        if service["name"].startswith("Rejected"):
+            raise RuntimeError("simulated publish error")
+        published.append(service["name"])
+        return True
+    monkeypatch.setattr(updateServices, "stageService", stageService)
+    monkeypatch.setattr(updateServices, "publishService", publishService)
+    return published
+
+def process(services, tmp_path, pipeline=None):
+    pipeline = pipeline or {"enabled":False}
+    updateServices.processServices(None, services, str(tmp_path), "", "", pipeline, {}, updateServices.getProjectCacheSettings({}), None)
+
+def test_sequential_errors_only_fail_their_service(portal, tmp_path, logfile):
+    services = makeServices(["Broken_A", "Rejected_B", "Fine_C"])
+    process(services, tmp_path)
+    updateServices.Log.flush()
+    assert portal == ["Fine_C"]
+    assert [service["sync"]["last"] for service in services][:2] == ["2000-01-01", "2000-01-01"]
+    assert services[2]["sync"]["last"] != "2000-01-01"
+    log = logfile.read_text()
+    assert "[FAIL] Failed to stage Broken_A" in log
+    assert "[FAIL] Failed to publish Rejected_B" in log
+
+def test_portal_threads_run_arcpy_tools_one_at_a_time():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    running = []
+    overlaps = []
+    def tool(path):
+        running.append(path)
+        overlaps.append(len(running))
+        threading.Event().wait(0.01)
+        running.remove(path)
+        return path
+    with ThreadPoolExecutor(max_workers=4) as publishers:
+        paths = list(publishers.map(lambda path: updateServices.runTool(tool, path), range(8)))
+    assert paths == list(range(8))
+    assert max(overlaps) == 1
+
+@pytest.fixture
+def crashing(portal, tmp_path, monkeypatch):
+    # Staging processes end like an ArcGIS Pro crash while they stage a Crash_ service, and a
+    # Once_ service only crashes the first process that stages it
+    def stageService(service, staging, previous=None):
+        name = service["name"]
+        marker = tmp_path / "{}.crashed".format(name)
+        if name.startswith("Crash") or (name.startswith("Once") and not marker.exists()):
+            marker.write_text("")
+            updateServices.Log.flush()
+            updateServices.os._exit(3)
+        return staged(service)
+    monkeypatch.setattr(updateServices, "stageService", stageService)
+    return portal
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="the stand-in stageService only reaches forked workers")
+def test_crashed_lane_is_restarted_and_the_crashing_service_given_up(crashing, tmp_path, logfile):
+    services = makeServices(["A1", "Crash_A2", "A3"], "A.aprx") + makeServices(["Once_B1", "B2"], "B.aprx")
+    process(services, tmp_path, {"enabled":True, "staging_workers":2, "portal_workers":2})
+    updateServices.Log.flush()
+    assert sorted(crashing) == ["A1", "A3", "B2", "Once_B1"]
+    assert [service["name"] for service in services if service["sync"]["last"] == "2000-01-01"] == ["Crash_A2"]
+    log = logfile.read_text()
+    assert "[INFO] Staging worker crashed while staging Once_B1, restarting it" in log
+    assert "[FAIL] Staging Crash_A2 crashed the worker process 2 times, giving up on it" in log
@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import pytest
+
+import updateServices
+
+def makeServices(names, project):
+    return [{"name":name, "project":project} for name in names]
+
+def test_lanes_keep_each_project_in_one_lane():
+    services = makeServices(["A1", "A2", "A3"], "A.aprx") + makeServices(["B1", "B2"], "B.aprx") + makeServices(["C1"], "C.aprx") + makeServices(["D1"], "D.aprx")
+    lanes = updateServices.assignLanes(services, 2)
+    assert sorted(len(lane) for lane in lanes) == [3, 4]
+    for lane in lanes:
+        for project in ["A.aprx", "B.aprx", "C.aprx", "D.aprx"]:
+            members = [service for service in services if service["project"] == project]
+            assert all(service in lane for service in members) or not any(service in lane for service in members)
+
+def test_no_more_lanes_than_projects():
+    lanes = updateServices.assignLanes(makeServices(["A1", "A2"], "A.aprx"), 4)
+    assert [[service["name"] for service in lane] for lane in lanes] == [["A1", "A2"]]
+
+@pytest.fixture
+def opened(tmp_path, monkeypatch):
+    # Counts the projects opened by the stand-in arcpy
+    import arcpy
+    monkeypatch.setattr(updateServices, "arcpy", arcpy)
+    opened = []
+    ArcGISProject = arcpy.mp.ArcGISProject
+    def openProject(path):
+        opened.append(updateServices.os.path.basename(path))
+        return ArcGISProject(path)
+    monkeypatch.setattr(arcpy.mp, "ArcGISProject", openProject)
+    return lambda name: str(tmp_path / name), opened
+
+def test_least_recently_used_project_is_released(opened):
+    path, opened = opened
+    cache = updateServices.ProjectCache(max_projects=2)
+    for name in ["A.aprx", "B.aprx", "A.aprx", "C.aprx", "A.aprx", "B.aprx"]:
+        cache.getProject(path(name))
+    # B was used less recently than A when C was opened
+    assert opened == ["A.aprx", "B.aprx", "C.aprx", "B.aprx"]
+
+def test_projects_are_released_over_the_memory_limit(opened, monkeypatch):
+    path, opened = opened
+    rss = {"mb":100}
+    monkeypatch.setattr(updateServices, "psutil", SimpleNamespace(Process=lambda: SimpleNamespace(memory_info=lambda: SimpleNamespace(rss=rss["mb"] * 1024 * 1024))))
+    cache = updateServices.ProjectCache(max_projects=5, max_memory_mb=500)
+    cache.getProject(path("A.aprx"))
+    cache.getProject(path("B.aprx"))
+    rss["mb"] = 800
+    cache.getProject(path("C.aprx"))
+    # The project in use is kept even over the limit
+    assert list(cache.projects) == [updateServices.os.path.normcase(path("C.aprx"))]
+
+def test_reused_map_has_its_selection_cleared(opened, monkeypatch):
+    path, opened = opened
+    cache = updateServices.ProjectCache()
+    cache.getProject(path("A.aprx"))
+    mapview = cache.getMap(path("A.aprx"), "Map")
+    cleared = []
+    monkeypatch.setattr(mapview, "clearSelection", lambda: cleared.append(mapview.name))
+    assert cache.getMap(path("A.aprx"), "Map") is mapview
+    assert cleared == ["Map"]
+    assert opened == ["A.aprx"]
@@ -0,0 +1,38 @@
+import pytest
+
+import updateServices
+
+@pytest.mark.parametrize("error", [
+    ConnectionError("Connection reset by peer"),
+    TimeoutError("The read operation timed out"),
+    Exception("Error Code: 503 Service Unavailable"),
+    Exception({"code":429, "message":"Too many requests"}),
+    Exception("Unable to complete operation, try again later")
+])
+def test_temporary_errors_are_retried(error):
+    assert updateServices.isRetryable(error)
+
+@pytest.mark.parametrize("error", [
+    Exception("Item 5003ab does not exist"),
+    Exception("Item 50f2ab04 was not found, error 404"),
+    Exception("Invalid connection file"),
+    Exception({"code":403, "message":"You do not have permissions to access this resource"}),
+    Exception("ERROR 000732: Input Dataset does not exist or is not supported"),
+    Exception("ERROR 999999: Something unexpected caused the tool to fail"),
+    updateServices.FatalError("Upload failed")
+])
+def test_other_errors_are_not_retried(error):
+    assert not updateServices.isRetryable(error)
+
+class Item:
+    title = "VT_Test"
+
+    def __init__(self, result):
+        self.result = result
+
+    def delete(self, dry_run=False):
+        return self.result
+
+def test_delete_checks_the_result():
+    assert updateServices.deleteItem(Item(True), False)
+    assert not updateServices.deleteItem(Item(False), False)
@@ -0,0 +1,155 @@
+import io
+import json
+import struct
+import zipfile
+from itertools import combinations
+from types import SimpleNamespace
+
+import pytest
+
+import updateServices
+from updateServices import BUNDLE_HEADER, BUNDLE_RECORDS
+
+def writeBundle(tiles):
+    # Compact cache V2 bundle with the given {position: bytes} tiles, written independently of
+    # mergeBundles: header, 128x128 index of 5 byte offset and 3 byte size, length prefixed tiles
+    index = [0] * BUNDLE_RECORDS
+    data = io.BytesIO()
+    start = BUNDLE_HEADER.size + 8 * BUNDLE_RECORDS
+    for position, tile in sorted(tiles.items()):
+        data.write(struct.pack("<I", len(tile)))
+        index[position] = (len(tile) << 40) | (start + data.tell())
+        data.write(tile)
+    bundle = io.BytesIO()
+    bundle.write(b"\0" * BUNDLE_HEADER.size)
+    bundle.write(struct.pack("<{}Q".format(BUNDLE_RECORDS), *index))
+    bundle.write(data.getvalue())
+    bundle.seek(0)
+    return bundle
+
+def readTiles(bundle):
+    tiles = {}
+    for position, (offset, size) in enumerate(updateServices.readBundleIndex(bundle)):
+        if size:
+            bundle.seek(offset - 4)
+            assert struct.unpack("<I", bundle.read(4))[0] == size
+            tiles[position] = bundle.read(size)
+    return tiles
+
+def test_merged_bundle_holds_the_tiles_of_every_shard():
+    first = {0:b"a" * 10, 5:b"b" * 300, 16383:b"c"}
+    second = {5:b"B" * 300, 6:b"d" * 7, 200:b"e" * 1000}
+    merged = io.BytesIO()
+    updateServices.mergeBundles([writeBundle(first), writeBundle(second)], merged)
+    expected = dict(second)
+    expected.update(first)
+    assert readTiles(merged) == expected
+    header = BUNDLE_HEADER.unpack(merged.getvalue()[:BUNDLE_HEADER.size])
+    assert header[0] == 3 and header[1] == BUNDLE_RECORDS
+    assert header[2] == 1000
+    assert header[5] == len(merged.getvalue())
+
+def test_merged_bundle_of_empty_shards_is_empty():
+    merged = io.BytesIO()
+    updateServices.mergeBundles([writeBundle({}), writeBundle({})], merged)
+    assert readTiles(merged) == {}
+    assert len(merged.getvalue()) == BUNDLE_HEADER.size + 8 * BUNDLE_RECORDS
+
+def rootJson(xmin, ymin, xmax, ymax, levels):
+    extent = {"xmin":xmin, "ymin":ymin, "xmax":xmax, "ymax":ymax, "spatialReference":{"wkid":3857}}
+    return {
+        "minLOD":levels[0],
+        "maxLOD":levels[-1],
+        "minScale":updateServices.levelScale(levels[0]),
+        "maxScale":updateServices.levelScale(levels[-1]),
+        "fullExtent":dict(extent),
+        "initialExtent":dict(extent),
+        "tileInfo":{"lods":[{"level":level, "scale":updateServices.levelScale(level)} for level in levels]}
+    }
+
+def test_merged_root_json_covers_every_shard():
+    merged = json.loads(updateServices.mergeRootJson([rootJson(0, 0, 10, 10, [19, 20]), rootJson(5, -5, 20, 8, [21]), rootJson(-3, 2, 4, 30, [19])]))
+    assert (merged["minLOD"], merged["maxLOD"]) == (19, 21)
+    assert merged["minScale"] == updateServices.levelScale(19)
+    assert merged["maxScale"] == updateServices.levelScale(21)
+    for key in ["fullExtent", "initialExtent"]:
+        assert [merged[key][corner] for corner in ["xmin", "ymin", "xmax", "ymax"]] == [-3, -5, 20, 30]
+    assert [lod["level"] for lod in merged["tileInfo"]["lods"]] == [19, 20, 21]
+
+def test_merged_tile_package(tmp_path):
+    shards = []
+    for i, (tiles, document) in enumerate([({1:b"one"}, rootJson(0, 0, 1, 1, [19])), ({2:b"two"}, rootJson(1, 1, 2, 2, [20]))]):
+        path = str(tmp_path / "shard_{}.tpkx".format(str(i)))
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as package:
+            package.writestr("tile/L19/R0000C0000.bundle", writeBundle(tiles).getvalue())
+            package.writestr("root.json", json.dumps(document))
+            package.writestr("esriinfo/iteminfo.xml", "shard {}".format(str(i)))
+        shards.append(path)
+    target = str(tmp_path / "merged.tpkx")
+    updateServices.mergeTilePackages(shards, target)
+    with zipfile.ZipFile(target) as package:
+        assert readTiles(io.BytesIO(package.read("tile/L19/R0000C0000.bundle"))) == {1:b"one", 2:b"two"}
+        assert json.loads(package.read("root.json"))["maxLOD"] == 20
+        assert package.read("esriinfo/iteminfo.xml") == b"shard 0"
+
+@pytest.mark.parametrize("levels", [updateServices.TILE_LEVELS, updateServices.VECTOR_LEVELS])
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 5, 50])
+def test_level_ranges_cover_every_level_once(levels, size):
+    covered = []
+    for low, high in updateServices.levelRanges(levels, size):
+        assert low <= high
+        assert not size or high - low + 1 <= size
+        covered.extend(range(low, high + 1))
+    assert covered == list(range(levels[0], levels[1] + 1))
+
+class Box:
+    # Just enough of an arcpy Polygon for splitArea: axis aligned rectangles
+    spatialReference = None
+
+    def __init__(self, xmin, ymin, xmax, ymax):
+        self.extent = SimpleNamespace(XMin=xmin, YMin=ymin, XMax=xmax, YMax=ymax)
+        self.area = (xmax - xmin) * (ymax - ymin)
+        self.JSON = json.dumps([xmin, ymin, xmax, ymax])
+
+    def intersect(self, other, dimension):
+        a, b = self.extent, other.extent
+        xmin, ymin, xmax, ymax = max(a.XMin, b.XMin), max(a.YMin, b.YMin), min(a.XMax, b.XMax), min(a.YMax, b.YMax)
+        return Box(xmin, ymin, xmax, ymax) if xmin < xmax and ymin < ymax else None
+
+def polygon(points, sr):
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    return Box(min(xs), min(ys), max(xs), max(ys))
+
+@pytest.mark.parametrize("grid", [1, 2, 3, 4])
+def test_split_area_covers_the_area_without_overlaps(monkeypatch, grid):
+    monkeypatch.setattr(updateServices, "arcpy", SimpleNamespace(Polygon=polygon, Array=list, Point=lambda x, y: (x, y)))
+    area = Box(-120.5, 30.25, 80.0, 95.0)
+    pieces = [Box(*json.loads(piece)) for piece in updateServices.splitArea(area, grid)]
+    assert len(pieces) == grid * grid
+    assert sum(piece.area for piece in pieces) == pytest.approx(area.area)
+    for piece in pieces:
+        assert area.intersect(piece, 4).area == pytest.approx(piece.area)
+    for first, second in combinations(pieces, 2):
+        overlap = first.intersect(second, 4)
+        assert overlap is None or overlap.area == pytest.approx(0)
+
+@pytest.mark.parametrize("shard_levels, stages", [(0, ["packaging"]), (4, ["packaging shard", "merging shards"])])
+def test_sharded_packaging_is_not_counted_twice(tmp_path, monkeypatch, shard_levels, stages):
+    import arcpy
+    monkeypatch.setattr(updateServices, "arcpy", arcpy)
+    monkeypatch.setattr(updateServices, "projects", updateServices.ProjectCache())
+    def packageSharded(service, mapview, aoi_layer, pk_path, settings):
+        # Records the spans of the real packageSharded without a pool of processes
+        with updateServices.timings.span("packaging shard", service["name"]):
+            arcpy.management.CreateVectorTilePackage(mapview, pk_path)
+        with updateServices.timings.span("merging shards", service["name"]):
+            pass
+        return True
+    monkeypatch.setattr(updateServices, "packageSharded", packageSharded)
+    service = {"name":"Shard_Test", "type":"REPLACEVECTORTILE", "project":str(tmp_path / "Project.aprx"), "map":"Map", "parameters":{"shard_levels":shard_levels, "tile_structure":"FLAT"}}
+    updateServices.timings.drain()
+    result = updateServices.stageMap(service, str(tmp_path), None)
+    assert result["staged"]
+    packaging = [span["stage"] for span in updateServices.timings.drain() if "packaging" in span["stage"] or "shards" in span["stage"]]
+    assert packaging == stages
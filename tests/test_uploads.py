@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+import benchsim
+import updateServices
+from arcgis.gis import GIS, portal
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = updateServices.StagingCache()
+    cache.configure(str(tmp_path), chunked=True, chunk_mb=1, workers=2)
+    return cache
+
+def package(tmp_path, name="Tiles_20240101_000000.tpkx", megabytes=5):
+    path = str(tmp_path / name)
+    benchsim.writeFile(path, megabytes)
+    return path
+
+def properties(path):
+    return {"type":"Compact Tile Package", "title":os.path.splitext(os.path.basename(path))[0], "tags":"test", "snippet":"test"}
+
+def test_interrupted_upload_resumes_on_the_next_run(tmp_path, cache, monkeypatch):
+    path = package(tmp_path)
+    digest = updateServices.hashFile(path)
+    sent = []
+    failed = []
+    uploadPart = updateServices.StagingCache.uploadPart
+    def failing(self, gis, owner, itemid, path, part, name):
+        if part == 4 and not failed:
+            failed.append(part)
+            raise ConnectionError("Simulated connection reset")
+        sent.append(part)
+        return uploadPart(self, gis, owner, itemid, path, part, name)
+    monkeypatch.setattr(updateServices.StagingCache, "uploadPart", failing)
+    with pytest.raises(ConnectionError):
+        cache.add(GIS(), "bench", path, digest, "Tiles", properties(path), fingerprint="f1")
+    manifest = updateServices.getPendingUpload(str(tmp_path), "Tiles")
+    assert manifest["path"] == path and manifest["created"]
+
+    # The next run stages a new package, it is replaced by the one of the interrupted upload
+    result = {"fingerprint":"f1", "path":None, "hash":None, "package":"Tiles_20240102_000000", "staged":False}
+    assert updateServices.reusePendingUpload(str(tmp_path), "Tiles", result)
+    assert (result["path"], result["hash"], result["package"]) == (path, digest, "Tiles_20240101_000000")
+    assert sorted(manifest["done"]) == [part for part in range(1, manifest["parts"] + 1) if part != 4]
+    del sent[:]
+    itemid = cache.add(GIS(), "bench", result["path"], result["hash"], "Tiles", properties(path), fingerprint="f1")
+    assert itemid == manifest["item"]
+    assert sent == [4]
+    assert updateServices.getPendingUpload(str(tmp_path), "Tiles") is None
+
+def test_changed_source_is_not_reused(tmp_path, cache):
+    path = package(tmp_path)
+    os.mkdir(str(tmp_path / "uploads"))
+    with open(str(tmp_path / "uploads" / "Tiles.json"), 'w') as f:
+        f.write('{"path":"%s", "digest":"d", "fingerprint":"f1"}' % path)
+    result = {"fingerprint":"f2", "path":None, "hash":None, "package":None, "staged":False}
+    assert not updateServices.reusePendingUpload(str(tmp_path), "Tiles", result)
+
+def test_expired_upload_is_dropped_with_its_item(tmp_path, cache, monkeypatch):
+    path = package(tmp_path)
+    monkeypatch.setattr(updateServices.StagingCache, "uploadPart", lambda *args: (_ for _ in ()).throw(ConnectionError("reset")))
+    with pytest.raises(ConnectionError):
+        cache.add(GIS(), "bench", path, updateServices.hashFile(path), "Tiles", properties(path))
+    itemid = updateServices.getPendingUpload(str(tmp_path), "Tiles")["item"]
+    assert portal.get(itemid) is not None
+    cache.expire(GIS())
+    assert updateServices.getPendingUpload(str(tmp_path), "Tiles") is not None
+    cache.resume_hours = 0
+    cache.expire(GIS())
+    assert updateServices.getPendingUpload(str(tmp_path), "Tiles") is None
+    assert portal.get(itemid) is None
+    assert not os.path.exists(path)
+
+def test_rejected_update_is_not_recorded(tmp_path, cache):
+    path = package(tmp_path, "Features.sd", 0.5)
+    item = portal.create("Features", "Service Definition", "bench")
+    item.update = lambda data=None: False
+    try:
+        with pytest.raises(updateServices.FatalError):
+            cache.update(GIS(), item, path, "digest", "Features", "f1")
+        assert not cache.isUploaded(item.id, "f1")
+    finally:
+        portal.remove(item.id)
+
+def test_package_of_the_same_source_is_not_uploaded_again(tmp_path, cache):
+    item = portal.create("Features", "Service Definition", "bench")
+    uploads = []
+    item.update = lambda data=None: uploads.append(data) or True
+    try:
+        first = package(tmp_path, "Features_1.sd", 0.5)
+        cache.update(GIS(), item, first, updateServices.hashFile(first), "Features", "f1")
+        # Staged again from the same source, the package differs by its build time
+        second = package(tmp_path, "Features_2.sd", 0.5)
+        assert updateServices.hashFile(first) != updateServices.hashFile(second)
+        cache.update(GIS(), item, second, updateServices.hashFile(second), "Features", "f1")
+        third = package(tmp_path, "Features_3.sd", 0.5)
+        cache.update(GIS(), item, third, updateServices.hashFile(third), "Features", "f2")
+    finally:
+        portal.remove(item.id)
+    assert uploads == [first, third]
+
+def test_deleted_packages_are_dropped_from_the_cache_index(tmp_path, cache):
+    kept = package(tmp_path, "Tiles_1.tpkx", 0.1)
+    deleted = package(tmp_path, "Tiles_2.tpkx", 0.1)
+    cache.touch(kept)
+    cache.touch(deleted)
+    os.remove(deleted)
+    cache.save()
+    assert list(cache.entries["used"]) == ["Tiles_1.tpkx"]
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import updateServices
+
+def test_dates_keep_their_milliseconds():
+    assert updateServices.toEpoch(datetime(2024, 3, 1, 12, 30, 15, 250000)) == 1709296215250
+
+def test_dates_are_read_in_the_time_zone_of_the_source():
+    zone = updateServices.getTimeZone("America/Chicago")
+    # Central Standard Time in winter, Central Daylight Time in summer
+    assert updateServices.toEpoch(datetime(2024, 1, 15, 6, 0), zone) == updateServices.toEpoch(datetime(2024, 1, 15, 12, 0))
+    assert updateServices.toEpoch(datetime(2024, 7, 15, 7, 0), zone) == updateServices.toEpoch(datetime(2024, 7, 15, 12, 0))
+
+def test_local_dates_use_the_clock_of_this_machine():
+    value = datetime(2024, 7, 15, 7, 0)
+    assert updateServices.toEpoch(value, updateServices.getTimeZone("local")) == int(value.timestamp() * 1000)
+
+def test_aware_dates_and_other_values_are_kept():
+    assert updateServices.toEpoch(datetime(2024, 1, 1, tzinfo=timezone.utc), None) == 1704067200000
+    assert updateServices.toEpoch("K1") == "K1"
+
+@pytest.fixture
+def upsert(tmp_path, monkeypatch):
+    # A two layer map of the stand-in arcpy with a previous push recorded for every row
+    import sys
+    import arcpy
+    import benchsim
+    monkeypatch.setattr(updateServices, "arcpy", arcpy)
+    monkeypatch.setattr(sys, "path", [str(tmp_path)] + sys.path[1:])
+    monkeypatch.setitem(benchsim.settings, "layers", 1)
+    monkeypatch.setitem(benchsim.settings, "rows", 5)
+    service = {"name":"Upsert_Test", "parameters":{"key_field":"ASSET_ID"}}
+    mapview = arcpy.mp.ArcGISProject(str(tmp_path / "Project.aprx")).listMaps("Map")[0]
+    staging = tmp_path / "staging"
+    staging.mkdir()
+    def stage():
+        result = {"name":service["name"], "staged":False, "path":None, "pending":None, "upsert":False}
+        return updateServices.stageUpsert(service, mapview, str(staging), result)
+    staged = stage()
+    updateServices.os.replace(staged["pending"], updateServices.getUpsertState(service)[0])
+    return stage, arcpy, service
+
+def test_unique_keys_send_changes(upsert):
+    stage, arcpy, service = upsert
+    staged = stage()
+    assert staged["upsert"] and staged["path"].endswith(".changes.json")
+
+@pytest.mark.parametrize("key", [None, "K1"])
+def test_null_or_duplicate_keys_overwrite_the_service(upsert, monkeypatch, key):
+    stage, arcpy, service = upsert
+    rows = arcpy.SearchCursor.__iter__
+    def iterate(cursor):
+        for i, row in enumerate(rows(cursor)):
+            yield row if i != 3 else (key,) + row[1:]
+    monkeypatch.setattr(arcpy.SearchCursor, "__iter__", iterate)
+    staged = stage()
+    assert not staged["upsert"]
+    assert staged["path"].endswith(".sd")
+    assert not updateServices.os.path.exists(updateServices.getUpsertState(service)[0])
+
+def test_a_failed_hosted_key_query_fails_only_this_service(upsert):
+    stage, arcpy, service = upsert
+    staged = stage()
+    queried = []
+    class Layer:
+        def __init__(self, name):
+            self.properties = type("Properties", (), {"name":name, "objectIdField":"OBJECTID"})
+        def query(self, **kwargs):
+            queried.append(self.properties.name)
+            raise ConnectionError("Connection reset by peer")
+    class Index:
+        def get(self, itemid):
+            with open(staged["path"], 'r') as f:
+                names = updateServices.json.load(f)["layers"]
+            return type("Item", (), {"id":itemid, "layers":[Layer(name) for name in names]})
+    service["id"] = "hosted"
+    assert updateServices.upsertService(None, service, staged, Index()) is False
+    assert len(queried) == 1
@@ -1,18 +1,168 @@
-import arcpy
 import os
+import re
 import sys
 import json
-from time import sleep
-from arcgis.gis import GIS
-from datetime import datetime
+import heapq
+import argparse
+import importlib
+import hashlib
+import random
+import atexit
+import shutil
+import struct
+import zipfile
+import math
+import threading
+from time import sleep, time, perf_counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
 from dateutil import relativedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+# arcpy and the ArcGIS API for Python take tens of seconds to import, they are loaded by
+# importArcGIS() once there is work to do
+arcpy = None
+GIS = None
+
+def importArcGIS():
+    global arcpy, GIS
+    if arcpy is None:
+        arcpy = importlib.import_module("arcpy")
+    if GIS is None:
+        GIS = importlib.import_module("arcgis.gis").GIS
+
+# arcpy geoprocessing isn't thread-safe, the Portal threads run their tools one at a time
+arcpylock = threading.Lock()
+
+def runTool(tool, *args, **kwargs):
+    with arcpylock:
+        return tool(*args, **kwargs)
 
 class Log:
+    # Lines are buffered and appended to services.log in blocks, call Log.flush() before a
+    # process exits. Worker processes flush after every service they stage. [FAIL] lines are
+    # written at once and a background thread flushes every few seconds, so a hard crash of
+    # arcpy doesn't take the lines that explain it with it.
+    logfile = os.path.join(sys.path[0],"services.log")
+    buffer = []
+    limit = 200
+    interval = 2
+    lock = threading.Lock()
+    flusher = None
+
     def __init__(self, msg):
-        logfile = os.path.join(sys.path[0],"services.log")
-        with open(logfile, 'a') as f:
-            datestring = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            f.write("[{}] {}\n".format(datestring, msg))
+        datestring = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with Log.lock:
+            Log.buffer.append("[{}] {}\n".format(datestring, msg))
+            full = len(Log.buffer) >= Log.limit
+        if full or str(msg).startswith("[FAIL]"):
+            Log.flush()
+
+    @staticmethod
+    def flush():
+        with Log.lock:
+            lines = Log.buffer
+            Log.buffer = []
+            if lines:
+                with open(Log.logfile, 'a') as f:
+                    f.writelines(lines)
+
+    @staticmethod
+    def start():
+        # Starts the flushing thread of this process, threads don't survive a fork
+        if Log.flusher == os.getpid():
+            return
+        Log.flusher = os.getpid()
+        def flushing():
+            while True:
+                sleep(Log.interval)
+                Log.flush()
+        threading.Thread(target=flushing, daemon=True).start()
+
+    @staticmethod
+    def reset():
+        # Forked workers start with a copy of the parent's unflushed lines, which the parent
+        # writes itself, and of its lock, which may have been held by another thread
+        Log.lock = threading.Lock()
+        Log.buffer = []
+
+atexit.register(Log.flush)
+
+class Timings:
+    # Collects timing spans for the run report. Each span is a dict so a stage can attach
+    # extra measurements (bytes, attempts) to it while it runs.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage, service, **fields):
+        record = {"stage":stage, "service":service, "started":datetime.now().isoformat(), "ok":True}
+        record.update(fields)
+        began = perf_counter()
+        try:
+            yield record
+        except:
+            record["ok"] = False
+            raise
+        finally:
+            record["seconds"] = round(perf_counter() - began, 3)
+            with self.lock:
+                self.spans.append(record)
+
+    def drain(self):
+        with self.lock:
+            spans = self.spans
+            self.spans = []
+        return spans
+
+    def extend(self, spans):
+        with self.lock:
+            self.spans.extend(spans)
+
+timings = Timings()
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, int(round(p / 100.0 * len(ordered))) - 1)]
+
+def writeReport(path, spans, started):
+    # JSON lines, one per span, followed by a summary of totals and p50/p95 per stage
+    stages = {}
+    services = {}
+    for span in spans:
+        stage = stages.setdefault(span["stage"], {"count":0, "failed":0, "seconds":[], "bytes":0, "attempts":0})
+        stage["count"] += 1
+        stage["failed"] += 0 if span["ok"] else 1
+        stage["seconds"].append(span["seconds"])
+        stage["bytes"] += span.get("bytes", 0)
+        stage["attempts"] += span.get("attempts", 1)
+        services[span["service"]] = round(services.get(span["service"], 0) + span["seconds"], 3)
+    summary = {}
+    for name, stage in stages.items():
+        summary[name] = {
+            "count":stage["count"],
+            "failed":stage["failed"],
+            "total":round(sum(stage["seconds"]), 3),
+            "p50":percentile(stage["seconds"], 50),
+            "p95":percentile(stage["seconds"], 95),
+            "bytes":stage["bytes"],
+            "retries":stage["attempts"] - stage["count"]
+        }
+    with open(path, 'w') as f:
+        for span in spans:
+            f.write(json.dumps(span, sort_keys=True) + "\n")
+        f.write(json.dumps({"summary":{"started":started.isoformat(), "seconds":round((datetime.now() - started).total_seconds(), 3), "stages":summary, "services":services}}, sort_keys=True) + "\n")
 
 def encode(key, string):
     encoded_chars = []
@@ -51,284 +201,2164 @@ def getSync(syncobj):
         if f == "yearly":
             freq["frequency"] = relativedelta.relativedelta(years=-1)
     return freq
-        
-
-configFile = os.path.join(sys.path[0],"settings.config")
-if not os.path.exists(configFile):
-    Log("[FAIL] No configuration file exists. Halting.")
-    exit(1)
-
-with open(configFile, 'r') as f:
-    config = json.load(f)
-    Log("[PASS] Loaded configuration")
-
-portal = config["portal"]
-username = config["username"]
-password = config["password"]
-services = config["services"]
-tasks = config["tasks"] if "tasks" in config else None
-encrypted = config["encrypted"] if "encrypted" in config else None
-
-if not encrypted:    
-    password = encode("shenannigans", password)
-    config["password"] = password
-    config["encrypted"] = True
-
-password = decode("shenannigans", password)
-retrylimit = config["retrylimit"] if config["retrylimit"] > 0 else 1
-staging = os.path.join(sys.path[0], "staging")
-arcpy.env.overwriteOutput = True
-
-Log("[INFO] {} services to update".format(str(len(services))))
-Log("[INFO] Retry limit set to {}".format(str(retrylimit)))
-Log("[INFO] Staging {}".format(staging))
-
-if not os.path.exists(staging):
+
+def getNextDue(syncobj):
+    # When a service or task is next due, None when it is never due
+    sync = getSync(syncobj)
+    if sync["frequency"] == "never":
+        return None
+    return sync["last"] - sync["frequency"]
+
+def isDue(syncobj):
+    due = getNextDue(syncobj)
+    return due is not None and due <= datetime.now()
+
+def hashFile(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def getPendingUpload(staging, name):
+    # The manifest of an interrupted upload of a service, None when there is none
+    manifestfile = os.path.join(staging, "uploads", "{}.json".format(name))
+    if not os.path.exists(manifestfile):
+        return None
     try:
-        os.mkdir(staging)
-        Log("[INFO] Created a staging folder")
+        with open(manifestfile, 'r') as f:
+            return json.load(f)
     except:
-        Log("[FAIL] Failed to create a staging folder")
-        exit(1)
+        return None
 
-try:
-    gis = GIS(portal, username, password)
-    Log("[PASS] Connected to Portal")
-except:
-    Log("[FAIL] Failed to Connect to Portal")
-    gis = None
+def reusePendingUpload(staging, name, result):
+    # Packages embed their build time, so a package staged again after an interrupted upload
+    # never matches the upload's manifest. As long as the source hasn't changed since (same
+    # fingerprint) the package of the interrupted upload is used instead.
+    manifest = getPendingUpload(staging, name)
+    if not (manifest and result["fingerprint"] and manifest.get("fingerprint") == result["fingerprint"] and os.path.exists(manifest["path"])):
+        return False
+    Log("[INFO] Reusing the package of the interrupted upload of {}".format(name))
+    result["path"] = manifest["path"]
+    result["hash"] = manifest["digest"]
+    result["package"] = manifest.get("package") or result["package"]
+    result["staged"] = True
+    return True
+
+class StagingCache:
+    # Manages the staging folder as a cache and uploads packages to the portal. Packages embed
+    # their build time, so the item's last upload is recorded by the fingerprint of the source
+    # it was built from: a package of the same source isn't sent again. Large packages go up
+    # in parallel parts and the parts that made it are recorded with the package's hash in a
+    # manifest per service under uploads/, so an interrupted upload resumes where it
+    # stopped. The package of an interrupted upload is kept until it is resumed or the
+    # manifest expires after resume_hours. Once the folder is larger than max_mb the least
+    # recently used files are removed.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folder = None
+        self.entries = {"used":{}, "uploads":{}}
+        self.configure()
+
+    def configure(self, folder=None, chunked=False, chunk_mb=64, workers=4, max_mb=10240, resume_hours=72):
+        self.folder = folder
+        self.chunked = chunked
+        self.chunk = int(chunk_mb * 1024 * 1024)
+        self.workers = max(1, int(workers))
+        self.max_mb = max_mb
+        self.resume_hours = resume_hours
+        if folder and os.path.exists(os.path.join(folder, "cache.json")):
+            try:
+                with open(os.path.join(folder, "cache.json"), 'r') as f:
+                    self.entries = json.load(f)
+            except:
+                Log("[INFO] Failed to read the staging cache index, starting a new one")
+
+    def save(self):
+        with self.lock:
+            # Packages deleted after they were published never reach evict()
+            self.entries["used"] = {name:used for name, used in self.entries["used"].items() if os.path.exists(os.path.join(self.folder, name))}
+            with open(os.path.join(self.folder, "cache.json"), 'w') as f:
+                json.dump(self.entries, f, indent=4, separators=(',',':'), sort_keys=True)
+
+    def touch(self, path):
+        with self.lock:
+            self.entries["used"][os.path.basename(path)] = time()
+
+    def isUploaded(self, key, fingerprint):
+        with self.lock:
+            return fingerprint is not None and self.entries["uploads"].get(key) == fingerprint
+
+    def markUploaded(self, key, fingerprint):
+        with self.lock:
+            self.entries["uploads"][key] = fingerprint
+
+    def manifests(self):
+        uploads = os.path.join(self.folder, "uploads")
+        if not os.path.exists(uploads):
+            return []
+        manifests = []
+        for entry in os.scandir(uploads):
+            if entry.is_file() and entry.name.endswith(".json"):
+                try:
+                    with open(entry.path, 'r') as f:
+                        manifest = json.load(f)
+                except:
+                    manifest = {}
+                manifest.setdefault("touched", entry.stat().st_mtime)
+                manifests.append([entry.path, manifest])
+        return manifests
+
+    def discard(self, gis, manifestfile, manifest, package=True):
+        # Drops an upload that won't be resumed: the item created for it, unless it was an
+        # existing item being updated, and its manifest and staged package
+        if manifest.get("created") and manifest.get("item"):
+            try:
+                item = gis.content.get(manifest["item"])
+                if item is not None:
+                    retrypolicy.call("delete", manifest["item"], item.delete)
+                Log("[INFO] Deleted item {} of an abandoned upload".format(manifest["item"]))
+            except Exception as e:
+                Log("[FAIL] Failed to delete item {} of an abandoned upload".format(manifest["item"]))
+                Log(e)
+        if package and manifest.get("path") and os.path.exists(manifest["path"]):
+            os.remove(manifest["path"])
+        if os.path.exists(manifestfile):
+            os.remove(manifestfile)
+
+    def expire(self, gis):
+        for manifestfile, manifest in self.manifests():
+            if time() - manifest["touched"] > self.resume_hours * 3600:
+                Log("[INFO] Upload {} was not resumed within {} hours, dropping it".format(os.path.basename(manifestfile), str(self.resume_hours)))
+                self.discard(gis, manifestfile, manifest)
+
+    def evict(self):
+        # Packages of uploads that can still be resumed are kept
+        pending = set(os.path.basename(manifest["path"]) for manifestfile, manifest in self.manifests() if manifest.get("path"))
+        files = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name != "cache.json" and entry.name not in pending:
+                stat = entry.stat()
+                files.append([max(stat.st_mtime, self.entries["used"].get(entry.name, 0)), stat.st_size, entry.path])
+        total = sum(size for used, size, path in files)
+        limit = self.max_mb * 1024 * 1024
+        for used, size, path in sorted(files):
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                with self.lock:
+                    self.entries["used"].pop(os.path.basename(path), None)
+                Log("[INFO] Evicted {} from the staging cache".format(os.path.basename(path)))
+            except OSError:
+                Log("[INFO] Failed to evict {} from the staging cache".format(path))
+
+    def restPost(self, gis, owner, path, params, files=None):
+        url = "{}content/users/{}/{}".format(gis._portal.resturl, owner, path)
+        params["f"] = "json"
+        response = gis._con.post(url, params, files=files) if files else gis._con.post(url, params)
+        if isinstance(response, dict) and "error" in response:
+            raise Exception(response["error"])
+        return response
+
+    def uploadPart(self, gis, owner, itemid, path, part, name):
+        # Parts are numbered from 1, each is written to its own file for the request
+        partfile = os.path.join(self.folder, "uploads", "{}_{}.part".format(itemid, str(part)))
+        with open(path, 'rb') as source, open(partfile, 'wb') as target:
+            source.seek((part - 1) * self.chunk)
+            target.write(source.read(self.chunk))
+        try:
+            retrypolicy.transfer("upload part", name, partfile, self.restPost, gis, owner, "items/{}/addPart".format(itemid), {"partNum":part}, files={"file":partfile})
+        finally:
+            os.remove(partfile)
+
+    def uploadStatus(self, gis, owner, itemid):
+        status = self.restPost(gis, owner, "items/{}/status".format(itemid), {})
+        if status.get("status") == "failed":
+            raise FatalError("Upload of {} failed: {}".format(itemid, status.get("statusMessage", "")))
+        return status.get("status") == "completed"
+
+    def multipart(self, gis, owner, path, digest, name, begin, properties, created=False, fingerprint=None, package=None):
+        # begin() opens the upload on the portal and returns the item id, it is skipped when
+        # resuming the upload recorded in the service's manifest. created is True when begin()
+        # adds a new item, which is deleted again if the upload is abandoned.
+        uploads = os.path.join(self.folder, "uploads")
+        if not os.path.exists(uploads):
+            os.mkdir(uploads)
+        manifestfile = os.path.join(uploads, "{}.json".format(name))
+        manifest = getPendingUpload(self.folder, name)
+        if manifest and (manifest.get("digest") != digest or manifest.get("chunk") != self.chunk):
+            # An upload of an older package of this service, the source changed since
+            self.discard(gis, manifestfile, manifest, manifest.get("path") != path)
+            manifest = None
+        if manifest is None:
+            manifest = {"digest":digest, "path":path, "fingerprint":fingerprint, "package":package, "created":created, "item":None, "chunk":self.chunk, "parts":max(1, int(math.ceil(os.path.getsize(path) / float(self.chunk)))), "done":[]}
+            manifest["item"] = begin()
+        else:
+            Log("[INFO] Resuming upload of {}, {} of {} parts already uploaded".format(name, str(len(manifest["done"])), str(manifest["parts"])))
+        manifest["touched"] = time()
+        itemid = manifest["item"]
+        with open(manifestfile, 'w') as f:
+            json.dump(manifest, f)
+
+        try:
+            pending = [part for part in range(1, manifest["parts"] + 1) if part not in manifest["done"]]
+            failure = None
+            with ThreadPoolExecutor(max_workers=self.workers) as uploaders:
+                jobs = {uploaders.submit(self.uploadPart, gis, owner, itemid, path, part, name): part for part in pending}
+                # Every part that arrives is recorded, also after another part failed
+                for job in as_completed(jobs):
+                    try:
+                        job.result()
+                    except Exception as e:
+                        failure = failure or e
+                        continue
+                    manifest["done"].append(jobs[job])
+                    with open(manifestfile, 'w') as f:
+                        json.dump(manifest, f)
+            if failure:
+                raise failure
+            retrypolicy.call("upload commit", name, self.restPost, gis, owner, "items/{}/commit".format(itemid), dict(properties))
+            retrypolicy.poll("upload commit", name, lambda: self.uploadStatus(gis, owner, itemid))
+        except Exception as e:
+            if not isRetryable(e):
+                # Resuming would fail the same way, the next run starts a new upload
+                Log("[INFO] Upload of {} can't be resumed, it starts over on the next run".format(name))
+                self.discard(gis, manifestfile, manifest, False)
+            raise
+        os.remove(manifestfile)
+        return itemid
+
+    def update(self, gis, item, path, digest, name, fingerprint=None):
+        # Replaces the data of an existing item, e.g. a Service Definition before an overwrite
+        if self.isUploaded(item.id, fingerprint):
+            Log("[SKIP] {} already holds a package of the same source, not uploading it again".format(item.id))
+            return
+        self.touch(path)
+        if self.chunked and os.path.getsize(path) > self.chunk:
+            def begin():
+                retrypolicy.call("upload", name, self.restPost, gis, item.owner, "items/{}/update".format(item.id), {"multipart":"true", "filename":os.path.basename(path)})
+                return item.id
+            self.multipart(gis, item.owner, path, digest, name, begin, {}, fingerprint=fingerprint)
+        elif not retrypolicy.transfer("upload", name, path, item.update, data=path):
+            raise FatalError("The portal did not accept {} for {}".format(os.path.basename(path), item.id))
+        self.markUploaded(item.id, fingerprint)
+
+    def add(self, gis, owner, path, digest, name, properties, folderid=None, fingerprint=None):
+        # Adds a package as a new item and returns its id
+        self.touch(path)
+        folder = "{}/".format(folderid) if folderid else ""
+        params = dict(properties)
+        params["multipart"] = "true"
+        params["filename"] = os.path.basename(path)
+        begin = lambda: retrypolicy.call("upload", name, self.restPost, gis, owner, "{}addItem".format(folder), params)["id"]
+        return self.multipart(gis, owner, path, digest, name, begin, properties, True, fingerprint, properties["title"])
+
+stagingcache = StagingCache()
+
+def getUploadSettings(config):
+    settings = {
+        "chunked":False,
+        "chunk_mb":64,
+        "workers":4,
+        "max_mb":10240,
+        "resume_hours":72
+    }
+    if "upload" in config:
+        settings["chunked"] = config["upload"]["chunked"] if "chunked" in config["upload"] else True
+        for setting in ["chunk_mb", "workers", "resume_hours"]:
+            if setting in config["upload"]:
+                settings[setting] = config["upload"][setting]
+    if "staging_cache" in config and "max_mb" in config["staging_cache"]:
+        settings["max_mb"] = config["staging_cache"]["max_mb"]
+    return settings
+
+def getPipeline(config):
+    # Concurrency limits for the pipelined execution mode. Staging runs arcpy in separate
+    # processes, the Portal stages (upload, publish, share, replace) run in threads.
+    pipeline = {
+        "enabled":False,
+        "staging_workers":1,
+        "portal_workers":1
+    }
+    if "pipeline" in config:
+        settings = config["pipeline"]
+        pipeline["enabled"] = settings["enabled"] if "enabled" in settings else True
+        for limit in ["staging_workers", "portal_workers"]:
+            if limit in settings:
+                pipeline[limit] = max(1, int(settings[limit]))
+    return pipeline
+
+class FatalError(Exception):
+    pass
+
+RETRYABLE_CODES = re.compile(r"\b(429|50[0234])\b")
+FATAL_CODES = re.compile(r"\b(400|401|403|404|498|499)\b")
+
+def isRetryable(e):
+    # Network hiccups, throttling and busy servers are worth another attempt, mistakes in
+    # the configuration or content (missing items, permissions, bad input) are not. Fatal
+    # markers are checked first and HTTP codes only match as whole numbers, item ids are hex.
+    # Anything not recognised, arcpy errors included, would most likely fail again.
+    if isinstance(e, FatalError):
+        return False
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    if isinstance(e, (KeyError, TypeError, ValueError, AttributeError, FileNotFoundError, PermissionError)):
+        return False
+    # requests raises its own ConnectionError and Timeout, which aren't the builtin ones
+    if type(e).__name__ in ["ConnectionError", "ConnectTimeout", "ReadTimeout", "Timeout", "ChunkedEncodingError"]:
+        return True
+    message = str(e).lower()
+    for marker in ["does not exist", "not found", "not authorized", "permission", "invalid", "already exists", "000732"]:
+        if marker in message:
+            return False
+    if FATAL_CODES.search(message):
+        return False
+    if RETRYABLE_CODES.search(message):
+        return True
+    for marker in ["timed out", "timeout", "connection reset", "connection aborted", "connection refused", "remote end closed", "too many requests", "try again", "temporarily", "unavailable", "busy"]:
+        if marker in message:
+            return True
+    return False
+
+class RetryPolicy:
+    # Shared by every Portal stage. Retries with exponential backoff and jitter up to the
+    # configured retrylimit and keeps per stage totals of attempts and time spent waiting.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.configure()
+
+    def configure(self, limit=1, base_delay=2, max_delay=120, poll_timeout=900):
+        self.limit = max(1, int(limit))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_timeout = poll_timeout
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return random.uniform(delay / 2, delay)
+
+    def record(self, stage, attempts, waited, failed=False):
+        with self.lock:
+            stats = self.stats.setdefault(stage, {"calls":0, "attempts":0, "waited":0.0, "failed":0})
+            stats["calls"] += 1
+            stats["attempts"] += attempts
+            stats["waited"] += waited
+            stats["failed"] += 1 if failed else 0
+
+    def call(self, stage, name, func, *args, **kwargs):
+        with timings.span(stage, name) as span:
+            value = self.attempt(span, stage, name, func, *args, **kwargs)
+        return value
+
+    def transfer(self, stage, name, path, func, *args, **kwargs):
+        # Same as call, for stages that send a file so the report includes bytes uploaded
+        with timings.span(stage, name, bytes=os.path.getsize(path)) as span:
+            value = self.attempt(span, stage, name, func, *args, **kwargs)
+        return value
+
+    def attempt(self, span, stage, name, func, *args, **kwargs):
+        attempts = 0
+        waited = 0.0
+        while True:
+            attempts += 1
+            span["attempts"] = attempts
+            span["waited"] = round(waited, 3)
+            try:
+                value = func(*args, **kwargs)
+            except Exception as e:
+                retryable = isRetryable(e)
+                if not retryable or attempts >= self.limit:
+                    self.record(stage, attempts, waited, True)
+                    Log("[FAIL] {} for {} failed, {} [Attempts: {}, Waited: {:.1f}s]".format(stage, name, "giving up" if retryable else "not retryable", str(attempts), waited))
+                    raise
+                delay = self.backoff(attempts)
+                Log("[INFO] {} for {} failed, retrying in {:.1f}s [Attempts: {}]".format(stage, name, delay, str(attempts)))
+                Log(e)
+                sleep(delay)
+                waited += delay
+                continue
+            self.record(stage, attempts, waited)
+            if attempts > 1:
+                Log("[INFO] {} for {} succeeded [Attempts: {}, Waited: {:.1f}s]".format(stage, name, str(attempts), waited))
+            return value
+
+    def poll(self, stage, name, check):
+        # Calls check until it returns True instead of sleeping for a fixed time. Retryable
+        # errors while polling count as not ready yet, fatal ones end the wait.
+        attempts = 0
+        waited = 0.0
+        delay = 1
+        started = time()
+        with timings.span(stage, name) as span:
+            while True:
+                attempts += 1
+                span["attempts"] = attempts
+                span["waited"] = round(waited, 3)
+                try:
+                    if check():
+                        self.record(stage, attempts, waited)
+                        Log("[INFO] {} for {} ready [Polls: {}, Waited: {:.1f}s]".format(stage, name, str(attempts), waited))
+                        return
+                except Exception as e:
+                    if not isRetryable(e):
+                        self.record(stage, attempts, waited, True)
+                        raise
+                remaining = self.poll_timeout - (time() - started)
+                if remaining <= 0:
+                    self.record(stage, attempts, waited, True)
+                    raise TimeoutError("{} for {} not ready after {:.0f}s".format(stage, name, waited))
+                pause = min(delay, remaining)
+                sleep(pause)
+                waited += pause
+                delay = min(delay * 2, self.max_delay)
+
+    def report(self):
+        # Logs the totals and starts new ones, each run of the daemon reports its own
+        with self.lock:
+            for stage in sorted(self.stats):
+                stats = self.stats[stage]
+                Log("[INFO] {}: {} calls, {} attempts, {} failed, {:.1f}s waiting".format(stage, str(stats["calls"]), str(stats["attempts"]), str(stats["failed"]), stats["waited"]))
+            self.stats = {}
 
-if gis:
+retrypolicy = RetryPolicy()
+
+def getRetrySettings(config, retrylimit):
+    settings = {
+        "limit":retrylimit,
+        "base_delay":2,
+        "max_delay":120,
+        "poll_timeout":900
+    }
+    if "retry" in config:
+        for setting in ["base_delay", "max_delay", "poll_timeout"]:
+            if setting in config["retry"]:
+                settings[setting] = config["retry"][setting]
+    return settings
+
+def itemReady(gis, itemid):
+    # A freshly published service item exists before its publishing job has finished
+    item = gis.content.get(itemid)
+    if item is None:
+        return False
+    try:
+        status = item.status()
+    except Exception:
+        return True
+    state = status.get("status", "completed") if isinstance(status, dict) else "completed"
+    if state == "failed":
+        raise FatalError("Publishing {} failed: {}".format(itemid, status.get("statusMessage", "")))
+    return state == "completed"
+
+class ProjectCache:
+    # Keeps ArcGIS Pro projects and their maps open for the rest of the run (or the life of a
+    # staging worker) so services that share an .aprx don't parse it again. Least recently
+    # used projects are dropped once max_projects or max_memory_mb is exceeded.
+    def __init__(self, max_projects=3, max_memory_mb=0):
+        self.max_projects = max(1, int(max_projects))
+        self.max_memory_mb = max_memory_mb
+        self.projects = OrderedDict()
+
+    def getProject(self, path):
+        key = os.path.normcase(os.path.abspath(path))
+        if key in self.projects:
+            self.projects.move_to_end(key)
+            return self.projects[key]["project"]
+        project = arcpy.mp.ArcGISProject(path)
+        self.projects[key] = {"project":project, "maps":{}}
+        self.evict()
+        return project
+
+    def getMap(self, path, name):
+        key = os.path.normcase(os.path.abspath(path))
+        maps = self.projects[key]["maps"]
+        if name not in maps:
+            maps[name] = self.projects[key]["project"].listMaps(name)[0]
+        mapview = maps[name]
+        # Selections from the previous service (e.g. AOI selections) would leak into this one
+        mapview.clearSelection()
+        return mapview
+
+    def evict(self):
+        while len(self.projects) > 1:
+            over_count = len(self.projects) > self.max_projects
+            over_memory = self.max_memory_mb and psutil and psutil.Process().memory_info().rss > self.max_memory_mb * 1024 * 1024
+            if not (over_count or over_memory):
+                break
+            key, entry = self.projects.popitem(last=False)
+            entry["maps"].clear()
+            Log("[INFO] Released cached project {}".format(key))
+
+projects = None
+
+def getProjectCacheSettings(config):
+    settings = {
+        "max_projects":3,
+        "max_memory_mb":0
+    }
+    if "project_cache" in config:
+        for limit in settings:
+            if limit in config["project_cache"]:
+                settings[limit] = config["project_cache"][limit]
+    return settings
+
+def initProjectCache(settings):
+    # Each staging and shard worker process keeps its own cache. Worker processes don't run
+    # main() so the arcpy environment is set here too.
+    global projects
+    importArcGIS()
+    projects = ProjectCache(settings["max_projects"], settings["max_memory_mb"])
+    arcpy.env.overwriteOutput = True
+
+def initWorker(settings):
+    # Initializer of the staging and shard worker processes
+    Log.reset()
+    Log.start()
+    initProjectCache(settings)
+
+class ContentIndex:
+    # In-memory index of one owner's Portal items, built from a single paginated listing
+    # per run and kept current as items are published and deleted. Lookups are exact,
+    # unlike the full-text search which matches titles loosely.
+    def __init__(self, gis, owner, page_size=100):
+        self.gis = gis
+        self.owner = owner
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.items = {}
+        self.titles = {}
+        self.types = {}
+        self.folders = {}
+
+    def build(self):
+        folders = retrypolicy.call("search", self.owner, lambda: self.gis.users.get(self.owner).folders)
+        for folder in folders:
+            self.folders[folder["title"]] = folder["id"]
+        for item in searchItems(self.gis, "owner:{}".format(self.owner), self.page_size):
+            self.add(item)
+        Log("[INFO] Indexed {} items owned by {}".format(str(len(self.items)), self.owner))
+        return self
+
+    def add(self, item):
+        with self.lock:
+            if item.id in self.items:
+                self.discard(item.id)
+            self.items[item.id] = item
+            self.titles.setdefault(item.title, set()).add(item.id)
+            self.types.setdefault(item.type, set()).add(item.id)
+
+    def discard(self, itemid):
+        item = self.items.pop(itemid)
+        self.titles[item.title].discard(itemid)
+        self.types[item.type].discard(itemid)
+
+    def remove(self, itemid):
+        with self.lock:
+            if itemid in self.items:
+                self.discard(itemid)
+
+    def refresh(self, itemid):
+        try:
+            item = self.gis.content.get(itemid)
+        except Exception as e:
+            Log("[INFO] Failed to refresh indexed item {}".format(itemid))
+            Log(e)
+            return self.get(itemid)
+        if item is None:
+            self.remove(itemid)
+        else:
+            self.add(item)
+        return item
+
+    def get(self, itemid):
+        with self.lock:
+            return self.items.get(itemid)
+
+    def find(self, title=None, item_type=None, folder=None):
+        with self.lock:
+            ids = set(self.items) if title is None else set(self.titles.get(title, ()))
+            if item_type is not None:
+                ids &= self.types.get(item_type, set())
+            items = [self.items[itemid] for itemid in ids]
+        if folder:
+            folderid = self.folders.get(folder, folder)
+            items = [item for item in items if getattr(item, "ownerFolder", None) == folderid]
+        return items
+
+    def match(self, prefix, content_type=None, folder=None):
+        # CLEAN candidates: titles starting with prefix, content_type matching an item type
+        # exactly or as its prefix (e.g. "Vector Tile" for Vector Tile Service and Package)
+        with self.lock:
+            types = [t for t in self.types if content_type is None or t == content_type or t.startswith(content_type)]
+        items = []
+        for item_type in types:
+            items.extend(item for item in self.find(item_type=item_type, folder=folder) if item.title.startswith(prefix))
+        return sorted(items, key=lambda item: item.created)
+
+def getContentIndex(gis, owner, indexes):
+    key = owner.lower()
+    if key not in indexes:
+        indexes[key] = ContentIndex(gis, owner).build()
+    return indexes[key]
+
+def loadFingerprints(path):
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                fingerprints = json.load(f)
+            # Caches written before row counts were kept hold just the hash
+            return {name:(entry if isinstance(entry, dict) else {"fingerprint":entry, "definition":None, "counts":{}}) for name, entry in fingerprints.items()}
+        except:
+            Log("[FAIL] Failed to read fingerprint cache {}, all services will be processed".format(path))
+    return {}
+
+def saveFingerprints(path, fingerprints):
+    with open(path, 'w') as f:
+        json.dump(fingerprints, f, indent=4, separators=(',',':'), sort_keys=True)
+
+def fingerprintMap(service, mapview, sddraft=None):
+    # Hashes everything that ends up in the published service: the service configuration,
+    # each layer's and standalone table's definition (symbology, labels, queries) and the
+    # state of its data source. Returns the hash, a hash of the configuration and layer
+    # definitions alone and the row count of each data source.
+    digest = hashlib.sha256()
+    definitions = hashlib.sha256()
+    counts = {}
+    settings = {k:v for k,v in service.items() if k not in ["sync", "force"]}
+    definitions.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    tables = mapview.listTables()
+    for layer in mapview.listLayers() + tables:
+        definitions.update(layer.longName.encode("utf-8"))
+        try:
+            definition = layer.getDefinition("V3")
+            definitions.update(json.dumps(definition, default=lambda o: getattr(o, "__dict__", str(o)), sort_keys=True).encode("utf-8"))
+        except:
+            pass
+        if layer in tables:
+            # Standalone tables are published as hosted tables, their rows count like a layer's
+            if layer.isBroken:
+                continue
+        elif not (layer.isFeatureLayer and layer.supports("DATASOURCE")):
+            continue
+        source = layer.dataSource
+        counts[source] = int(arcpy.management.GetCount(source)[0])
+        digest.update(source.encode("utf-8"))
+        digest.update(str(counts[source]).encode("utf-8"))
+        desc = arcpy.Describe(source)
+        edited = desc.editedAtFieldName if getattr(desc, "editorTrackingEnabled", False) else None
+        if edited:
+            # Editor tracking gives us the last edit cheaply, deletes are caught by the count
+            with arcpy.da.SearchCursor(source, [edited], sql_clause=(None, "ORDER BY {} DESC".format(edited))) as cursor:
+                for row in cursor:
+                    digest.update(str(row[0]).encode("utf-8"))
+                    break
+        else:
+            fields = [field.name for field in desc.fields if field.type not in ["Geometry", "Blob", "Raster"]]
+            if getattr(desc, "shapeFieldName", None):
+                fields.append("SHAPE@WKB")
+            with arcpy.da.SearchCursor(source, fields) as cursor:
+                for row in cursor:
+                    digest.update(repr(row).encode("utf-8"))
+    if sddraft:
+        with open(sddraft, 'rb') as f:
+            digest.update(f.read())
+    digest.update(definitions.digest())
+    return digest.hexdigest(), definitions.hexdigest(), counts
+
+def checkFingerprint(service, mapview, result, previous, sddraft=None):
+    # Records the fingerprint on the staging result and returns True when the service
+    # can be skipped because nothing changed since it was last published.
+    try:
+        with timings.span("fingerprint", service["name"]):
+            result["fingerprint"], result["definition"], result["counts"] = fingerprintMap(service, mapview, sddraft)
+    except Exception as e:
+        Log("[INFO] Failed to fingerprint {}, it will be published".format(service["name"]))
+        Log(e)
+        return False
+    if "force" in service and service["force"]:
+        Log("[INFO] Publishing {} regardless of changes, force is set".format(service["name"]))
+        return False
+    if previous and previous["fingerprint"] == result["fingerprint"]:
+        Log("[SKIP] unchanged, {} has not changed since it was last published".format(service["name"]))
+        result["unchanged"] = True
+        return True
+    return False
+
+# Level range of each tile type on the ONLINE tiling scheme
+VECTOR_LEVELS = (10, 21)
+TILE_LEVELS = (19, 21)
+BUNDLE_HEADER = struct.Struct("<4I3Q6I")
+BUNDLE_RECORDS = 128 * 128
+
+def levelScale(level):
+    return 591657527.591555 / (2 ** level)
+
+def getShardSettings(service):
+    settings = {
+        "shard_workers":1,
+        "shard_grid":1,
+        "shard_levels":0
+    }
+    if "parameters" in service:
+        for setting in settings:
+            if setting in service["parameters"]:
+                settings[setting] = max(0, int(service["parameters"][setting]))
+    settings["enabled"] = settings["shard_workers"] > 1 or settings["shard_grid"] > 1 or settings["shard_levels"] > 0
+    return settings
+
+def levelRanges(levels, size):
+    if not size:
+        return [levels]
+    return [(level, min(levels[1], level + size - 1)) for level in range(levels[0], levels[1] + 1, size)]
+
+def getAreaOfInterest(mapview, aoi_layer):
+    # The selected AOI features when there is an AOI layer, otherwise the extent of the map's data
+    area = None
+    if aoi_layer:
+        with arcpy.da.SearchCursor(aoi_layer, ["SHAPE@"]) as cursor:
+            for row in cursor:
+                area = row[0] if area is None else area.union(row[0])
+        return area
+    sr = mapview.spatialReference
+    for layer in mapview.listLayers():
+        if layer.isFeatureLayer and layer.supports("DATASOURCE"):
+            extent = arcpy.Describe(layer.dataSource).extent.projectAs(sr)
+            area = extent.polygon if area is None else area.union(extent.polygon)
+    return area
+
+def splitArea(area, grid):
+    if grid <= 1:
+        return [area.JSON]
+    extent = area.extent
+    width = (extent.XMax - extent.XMin) / grid
+    height = (extent.YMax - extent.YMin) / grid
+    pieces = []
+    for row in range(grid):
+        for column in range(grid):
+            xmin = extent.XMin + column * width
+            ymin = extent.YMin + row * height
+            corners = [(xmin, ymin), (xmin, ymin + height), (xmin + width, ymin + height), (xmin + width, ymin), (xmin, ymin)]
+            cell = arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for x, y in corners]), area.spatialReference)
+            piece = area.intersect(cell, 4)
+            if piece and piece.area > 0:
+                pieces.append(piece.JSON)
+    return pieces
+
+def packageShard(service, shard):
+    # Entry point of the shard worker processes, renders one area and level range
+    try:
+        with timings.span("packaging shard", service["name"], levels="{}-{}".format(shard["levels"][0], shard["levels"][1])) as span:
+            projects.getProject(service["project"])
+            mapview = projects.getMap(service["project"], service["map"])
+            low, high = shard["levels"]
+            if shard["format"] == "vtpk":
+                arcpy.management.CreateVectorTilePackage(mapview, shard["path"], "ONLINE", "", "FLAT", levelScale(low), levelScale(high))
+            else:
+                aoi = arcpy.AsShape(shard["aoi"], True)
+                aoi_features = arcpy.management.CopyFeatures([aoi], "memory\\shard_aoi")[0]
+                arcpy.management.CreateMapTilePackage(mapview, "ONLINE", shard["path"], "PNG8", high, None, '', '', aoi.extent, 75, 'tpkx', low, aoi_features)
+            span["bytes"] = os.path.getsize(shard["path"])
+        return {"path":shard["path"], "spans":timings.drain()}
+    finally:
+        Log.flush()
+
+def readBundleIndex(stream):
+    # Compact cache V2 bundle: 64 byte header, then 128x128 index entries of 5 byte offset
+    # and 3 byte size, each tile is stored behind a 4 byte length
+    stream.seek(BUNDLE_HEADER.size)
+    index = struct.unpack("<{}Q".format(BUNDLE_RECORDS), stream.read(8 * BUNDLE_RECORDS))
+    return [(entry & 0xFFFFFFFFFF, entry >> 40) for entry in index]
+
+def mergeBundles(sources, target):
+    # Tiles on a shard border are rendered by both shards from the same data and tiling
+    # scheme, so the first copy found is kept
+    tiles = [None] * BUNDLE_RECORDS
+    for stream in sources:
+        for position, (offset, size) in enumerate(readBundleIndex(stream)):
+            if size and tiles[position] is None:
+                tiles[position] = (stream, offset, size)
+    index = []
+    offset = BUNDLE_HEADER.size + 8 * BUNDLE_RECORDS
+    largest = 0
+    for tile in tiles:
+        if tile is None:
+            index.append(0)
+            continue
+        offset += 4
+        index.append((tile[2] << 40) | offset)
+        offset += tile[2]
+        largest = max(largest, tile[2])
+    target.write(BUNDLE_HEADER.pack(3, BUNDLE_RECORDS, largest, 5, 4, offset, 40, 20 + 8 * BUNDLE_RECORDS, 3, 16, BUNDLE_RECORDS, 5, 8 * BUNDLE_RECORDS))
+    target.write(struct.pack("<{}Q".format(BUNDLE_RECORDS), *index))
+    for tile in tiles:
+        if tile:
+            stream, start, size = tile
+            stream.seek(start)
+            target.write(struct.pack("<I", size))
+            target.write(stream.read(size))
+
+def mergeRootJson(documents):
+    # Widens the level range, scale range and extents of the first shard's metadata to cover all shards
+    merged = documents[0]
+    for document in documents[1:]:
+        for key, pick in [("minLOD", min), ("minzoom", min), ("maxLOD", max), ("maxzoom", max)]:
+            if key in merged and key in document:
+                merged[key] = pick(merged[key], document[key])
+        for key, pick in [("minScale", max), ("maxScale", min)]:
+            if key in merged and key in document:
+                merged[key] = 0 if 0 in [merged[key], document[key]] else pick(merged[key], document[key])
+        for key in ["fullExtent", "initialExtent"]:
+            if key in merged and key in document:
+                for corner, pick in [("xmin", min), ("ymin", min), ("xmax", max), ("ymax", max)]:
+                    merged[key][corner] = pick(merged[key][corner], document[key][corner])
+        if "tileInfo" in merged and "tileInfo" in document and "lods" in merged["tileInfo"]:
+            levels = {lod["level"]:lod for lod in merged["tileInfo"]["lods"] + document["tileInfo"].get("lods", [])}
+            merged["tileInfo"]["lods"] = [levels[level] for level in sorted(levels)]
+    return json.dumps(merged)
+
+def mergeTilePackages(paths, target):
+    # tpkx and vtpk files are uncompressed zip archives of bundles plus metadata. Bundles
+    # present in several shards are merged tile by tile, other files come from the first shard.
+    archives = [zipfile.ZipFile(path) for path in paths]
+    try:
+        members = OrderedDict()
+        for archive in archives:
+            for name in archive.namelist():
+                members.setdefault(name, []).append(archive)
+        with zipfile.ZipFile(target, 'w', zipfile.ZIP_STORED, allowZip64=True) as package:
+            for name, sources in members.items():
+                if name.endswith("/"):
+                    package.writestr(sources[0].getinfo(name), b"")
+                elif name.lower().endswith(".bundle") and len(sources) > 1:
+                    streams = [source.open(name) for source in sources]
+                    try:
+                        with package.open(name, 'w', force_zip64=True) as out:
+                            mergeBundles(streams, out)
+                    finally:
+                        for stream in streams:
+                            stream.close()
+                elif os.path.basename(name).lower() == "root.json" and len(sources) > 1:
+                    package.writestr(name, mergeRootJson([json.loads(source.read(name)) for source in sources]))
+                else:
+                    with sources[0].open(name) as source, package.open(name, 'w', force_zip64=True) as out:
+                        shutil.copyfileobj(source, out, 1024 * 1024)
+    finally:
+        for archive in archives:
+            archive.close()
+
+def packageSharded(service, mapview, aoi_layer, pk_path, settings):
+    # Splits the package into area and level shards, renders them in a pool of processes and
+    # merges the results into pk_path. Returns False when the package can't be sharded.
+    service_name = service["name"]
+    package_format = os.path.splitext(pk_path)[1][1:]
+    if package_format == "vtpk":
+        structure = service["parameters"]["tile_structure"] if "tile_structure" in service["parameters"] else "INDEXED"
+        if structure != "FLAT":
+            # The tile index of an INDEXED package depends on every level, it can't be split
+            Log("[INFO] Vector tile packages can only be sharded with a FLAT tile_structure, packaging {} in one piece".format(service_name))
+            return False
+        areas = [None]
+        levels = levelRanges(VECTOR_LEVELS, settings["shard_levels"])
+    else:
+        area = getAreaOfInterest(mapview, aoi_layer)
+        if area is None:
+            Log("[INFO] No area of interest to shard for {}, packaging in one piece".format(service_name))
+            return False
+        areas = splitArea(area, settings["shard_grid"])
+        levels = levelRanges(TILE_LEVELS, settings["shard_levels"])
+
+    shard_folder = "{}_shards".format(os.path.splitext(pk_path)[0])
+    if not os.path.exists(shard_folder):
+        os.mkdir(shard_folder)
+    shards = []
+    for level_range in levels:
+        for aoi in areas:
+            shard_path = os.path.join(shard_folder, "shard_{}.{}".format(str(len(shards)), package_format))
+            shards.append({"format":package_format, "aoi":aoi, "levels":level_range, "path":shard_path})
+    Log("[INFO] Packaging {} in {} shards with {} workers".format(service_name, str(len(shards)), str(settings["shard_workers"])))
+
+    paths = []
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, settings["shard_workers"]), initializer=initWorker, initargs=(getProjectCacheSettings({}),)) as packagers:
+            for packaged in packagers.map(packageShard, [service] * len(shards), shards):
+                timings.extend(packaged["spans"])
+                paths.append(packaged["path"])
+        with timings.span("merging shards", service_name) as span:
+            mergeTilePackages(paths, pk_path)
+            span["bytes"] = os.path.getsize(pk_path)
+    finally:
+        shutil.rmtree(shard_folder, ignore_errors=True)
+    Log("[PASS] Merged {} shards into {}".format(str(len(paths)), pk_path))
+    return True
+
+def getIncrementalSettings(service):
+    settings = {
+        "enabled":False,
+        "threshold":0.25
+    }
+    if "parameters" in service:
+        if "incremental" in service["parameters"]:
+            settings["enabled"] = service["parameters"]["incremental"]
+        if "incremental_threshold" in service["parameters"]:
+            settings["threshold"] = float(service["parameters"]["incremental_threshold"])
+    return settings
+
+def scanFootprints(mapview, since):
+    # One pass over every feature layer of the map, in its spatial reference: the extent of
+    # each feature by ObjectID and the ObjectIDs edited since the last update, from editor
+    # tracking. Returns None, None when a layer has no editor tracking.
+    sr = mapview.spatialReference
+    footprints = {}
+    edits = {}
+    for layer in mapview.listLayers():
+        if not (layer.isFeatureLayer and layer.supports("DATASOURCE")):
+            continue
+        source = layer.dataSource
+        desc = arcpy.Describe(source)
+        edited = desc.editedAtFieldName if getattr(desc, "editorTrackingEnabled", False) else None
+        if not edited:
+            Log("[INFO] {} has no editor tracking, changes can't be located".format(layer.name))
+            return None, None
+        extents = {}
+        recent = []
+        with arcpy.da.SearchCursor(source, ["OID@", "SHAPE@", edited], spatial_reference=sr) as cursor:
+            for oid, shape, stamp in cursor:
+                extents[str(oid)] = [shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax] if shape else None
+                if stamp is not None and stamp >= since:
+                    recent.append(str(oid))
+        footprints[source] = extents
+        edits[source] = recent
+    return footprints, edits
+
+def getChangedArea(sr, footprints, edits, previous):
+    # Area covered by the features edited, added or deleted since the footprints of the last
+    # update were recorded. Both the old and the new footprint of an edited feature are
+    # included, a feature that moved must disappear from where it was. Returns False when a
+    # layer has no footprints from the last update.
+    area = None
+    for source, extents in footprints.items():
+        if source not in previous:
+            Log("[INFO] {} is new since the last update, changes can't be located".format(source))
+            return False
+        before = previous[source]
+        changed = set(edits[source]) | (set(extents) ^ set(before))
+        for oid in changed:
+            for extent in [before.get(oid), extents.get(oid)]:
+                if extent:
+                    footprint = arcpy.Extent(*extent, spatial_reference=sr).polygon
+                    area = footprint if area is None else area.union(footprint)
+    return area
+
+def stageIncremental(service, mapview, aoi_layer, previous, result, pk_path):
+    # Packages only the tiles that intersect features edited, added or deleted since the last
+    # update. Returns the staging result, or None when the service needs a full rebuild. The
+    # footprints are recorded on the result either way, the next update compares with them.
+    service_name = service["name"]
+    settings = getIncrementalSettings(service)
+    with timings.span("footprints", service_name):
+        result["footprints"], edits = scanFootprints(mapview, getSync(service["sync"])["last"])
+    if not previous or ("force" in service and service["force"]) or result["footprints"] is None:
+        return None
+    if not result["definition"] or previous["definition"] != result["definition"]:
+        Log("[INFO] The configuration or layer definitions of {} changed, rebuilding all tiles".format(service_name))
+        return None
+    if not previous.get("footprints"):
+        Log("[INFO] No feature footprints were recorded when {} was last published, rebuilding all tiles".format(service_name))
+        return None
+    with timings.span("change detection", service_name):
+        changed = getChangedArea(mapview.spatialReference, result["footprints"], edits, previous["footprints"])
+        aoi = getAreaOfInterest(mapview, aoi_layer) if changed else None
+    if changed is False or (changed and aoi is None):
+        Log("[INFO] Rebuilding all tiles for {}".format(service_name))
+        return None
+    if changed:
+        changed = changed.intersect(aoi, 4)
+    if not changed or changed.area == 0:
+        Log("[SKIP] No edits in the area of interest of {}, tiles are current".format(service_name))
+        result["delta"] = {"empty":True}
+        result["staged"] = True
+        return result
+    share = changed.area / aoi.area
+    if share > settings["threshold"]:
+        Log("[INFO] {:.0%} of the area of interest of {} changed, above the threshold of {:.0%}, rebuilding all tiles".format(share, service_name, settings["threshold"]))
+        return None
+
+    delta_path = "{}_delta.tpkx".format(os.path.splitext(pk_path)[0])
+    Log("[INFO] Packaging tiles for {:.1%} of the area of interest of {}".format(share, service_name))
+    try:
+        with timings.span("packaging", service_name, incremental=True) as span:
+            changed_features = arcpy.management.CopyFeatures([changed], "memory\\changed_area")[0]
+            arcpy.management.CreateMapTilePackage(mapview, "ONLINE", delta_path, "PNG8", TILE_LEVELS[1], None, '', '', changed.extent, 75, 'tpkx', TILE_LEVELS[0], changed_features)
+            span["bytes"] = os.path.getsize(delta_path)
+        Log("[PASS] Tile package of changed areas generated successfully")
+    except:
+        Log("[FAIL] Failed to generate tile package of changed areas for {}, rebuilding all tiles".format(service_name))
+        Log(arcpy.GetMessages())
+        return None
+    result["delta"] = {
+        "empty":False,
+        "levels":",".join(str(level) for level in range(TILE_LEVELS[0], TILE_LEVELS[1] + 1)),
+        "extent":changed.extent.JSON
+    }
+    result["path"] = delta_path
+    result["staged"] = True
+    return result
+
+def stageDefinition(service, mapview, staging, result, previous=None, check=True):
+    # Drafts and stages a service definition (.sd) for a full overwrite of a feature layer
+    service_name = service["name"]
+    service_sddraft = os.path.join(staging, "{}.sddraft".format(service_name))
+    service_sd = os.path.join(staging,"{}.sd".format(service_name))
+    try:
+        with timings.span("draft export", service_name):
+            draft = mapview.getWebLayerSharingDraft("HOSTING_SERVER", "FEATURE", service_name)
+            draft.exportToSDDraft(service_sddraft)
+        Log("[PASS] Created Draft Service Definition for {}".format(service_name))
+    except Exception as e:
+        Log("[FAIL] Failed to create Draft Service Definition for {}".format(service_name))
+        Log(arcpy.GetMessages())
+        Log(e)
+        return result
+    if check and checkFingerprint(service, mapview, result, previous, service_sddraft):
+        return result
+    if reusePendingUpload(staging, service_name, result):
+        return result
+    try:
+        with timings.span("staging", service_name) as span:
+            arcpy.StageService_server(service_sddraft, service_sd)
+            span["bytes"] = os.path.getsize(service_sd)
+        Log("[PASS] Staged Service {}".format(service_name))
+        result["path"] = service_sd
+        result["staged"] = True
+    except:
+        Log("[FAIL] Failed to Stage Service {}".format(service_name))
+    return result
+
+def getUpsertSettings(service):
+    settings = {
+        "key_field":None,
+        "batch_size":1000,
+        "max_workers":2,
+        "time_zone":"UTC"
+    }
+    if "parameters" in service:
+        for setting in settings:
+            if setting in service["parameters"]:
+                settings[setting] = service["parameters"][setting]
+    return settings
+
+def getUpsertState(service):
+    # Row hashes and schema as of the last successful push, kept outside the staging folder
+    folder = os.path.join(sys.path[0], "upsert")
+    return os.path.join(folder, "{}.json".format(service["name"])), os.path.join(folder, "{}.pending.json".format(service["name"]))
+
+def getUpsertLayers(mapview, key_field):
+    # Feature layers of the map with the fields that are pushed, keyed by layer name
+    layers = {}
+    for layer in mapview.listLayers():
+        if not (layer.isFeatureLayer and layer.supports("DATASOURCE")):
+            continue
+        desc = arcpy.Describe(layer.dataSource)
+        tracking = [getattr(desc, name, "") for name in ["creatorFieldName", "createdAtFieldName", "editorFieldName", "editedAtFieldName"]]
+        fields = [field for field in desc.fields if field.editable and field.type not in ["OID", "Geometry", "GlobalID", "Blob", "Raster"] and field.name not in tracking]
+        if key_field not in [field.name for field in fields]:
+            raise FatalError("Layer {} has no key field {}".format(layer.name, key_field))
+        layers[layer.name] = {
+            "source":layer.dataSource,
+            "fields":[field.name for field in fields],
+            "schema":[[field.name, field.type, field.length] for field in fields]
+        }
+    return layers
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def getTimeZone(name):
+    # The time zone the dates of an UPSERT source are stored in, None for the time zone of
+    # the machine running the script
+    if name == "UTC":
+        return timezone.utc
+    if name == "local":
+        return None
+    if ZoneInfo is None:
+        raise FatalError("The time_zone {} needs Python 3.9 or later".format(name))
+    return ZoneInfo(name)
+
+def toEpoch(value, zone=timezone.utc):
+    # Dates are sent as epoch milliseconds, naive dates from the source are in its time zone
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.astimezone() if zone is None else value.replace(tzinfo=zone)
+        return (value - EPOCH) // timedelta(milliseconds=1)
+    return value
+
+def stageUpsert(service, mapview, staging, result):
+    # Compares every row with its hash from the last push and writes the rows that changed,
+    # plus the full key list so the Portal stage can find deletes. A schema change (or no
+    # previous push) falls back to staging a service definition for a full overwrite.
+    service_name = service["name"]
+    settings = getUpsertSettings(service)
+    key_field = settings["key_field"]
+    statefile, pendingfile = getUpsertState(service)
+    try:
+        zone = getTimeZone(settings["time_zone"])
+        layers = getUpsertLayers(mapview, key_field)
+    except Exception as e:
+        Log("[FAIL] Failed to read the layers of {} for an upsert".format(service_name))
+        Log(e)
+        return result
+    state = None
+    if os.path.exists(statefile):
+        with open(statefile, 'r') as f:
+            state = json.load(f)
+    schema = {name:layer["schema"] for name, layer in layers.items()}
+
+    pending = {"schema":schema, "layers":{}}
+    changes = {"key_field":key_field, "layers":{}}
+    invalid = None
+    with timings.span("row comparison", service_name) as span:
+        for name, layer in layers.items():
+            known = state["layers"].get(name, {}) if state else {}
+            hashes = {}
+            changed = []
+            key = layer["fields"].index(key_field)
+            with arcpy.da.SearchCursor(layer["source"], layer["fields"] + ["SHAPE@JSON"], spatial_reference=mapview.spatialReference) as cursor:
+                for row in cursor:
+                    # Rows sharing a key, or without one, can't be told apart on the portal
+                    if row[key] is None or str(row[key]) in hashes:
+                        invalid = "{} has {} {} values in {}".format(name, "null" if row[key] is None else "duplicate", key_field, service_name)
+                        break
+                    rowhash = hashlib.sha1(repr(row).encode("utf-8")).hexdigest()
+                    hashes[str(row[key])] = rowhash
+                    if known.get(str(row[key])) != rowhash:
+                        attributes = {field:toEpoch(value, zone) for field, value in zip(layer["fields"], row[:-1])}
+                        changed.append({"attributes":attributes, "geometry":json.loads(row[-1]) if row[-1] else None})
+            if invalid:
+                break
+            pending["layers"][name] = hashes
+            changes["layers"][name] = {"changes":changed, "keys":list(hashes)}
+            span["rows"] = span.get("rows", 0) + len(hashes)
+            span["changed"] = span.get("changed", 0) + len(changed)
+
+    if invalid:
+        # The row hashes no longer describe the hosted layer once it is overwritten, the first
+        # run with unique keys starts over with a full overwrite too
+        Log("[INFO] {}, key_field must be unique and not null, overwriting the whole service".format(invalid))
+        if os.path.exists(statefile):
+            os.remove(statefile)
+        return stageDefinition(service, mapview, staging, result, check=False)
+
+    if not os.path.exists(os.path.dirname(statefile)):
+        os.mkdir(os.path.dirname(statefile))
+    with open(pendingfile, 'w') as f:
+        json.dump(pending, f)
+    result["pending"] = pendingfile
+    if state is None or state["schema"] != schema:
+        Log("[INFO] {} for {}, overwriting the whole service".format("Schema changed" if state else "No previous upsert", service_name))
+        return stageDefinition(service, mapview, staging, result, check=False)
+
+    changes_path = os.path.join(staging, "{}.changes.json".format(service_name))
+    with open(changes_path, 'w') as f:
+        json.dump(changes, f)
+    Log("[PASS] Found {} changed rows in {}".format(str(sum(len(layer["changes"]) for layer in changes["layers"].values())), service_name))
+    result["upsert"] = True
+    result["path"] = changes_path
+    result["staged"] = True
+    return result
+
+def stageService(service, staging, previous=None):
+    # Local (arcpy) half of a service update. Runs in a worker process when the pipeline
+    # is enabled so everything returned has to be picklable. Staged packages are hashed
+    # here, in parallel, rather than in the Portal stage.
+    result = stageMap(service, staging, previous)
+    if result["staged"] and result["path"] and not result["hash"]:
+        with timings.span("hashing", service["name"]):
+            result["hash"] = hashFile(result["path"])
+    return result
+
+def stageMap(service, staging, previous=None):
+    service_name = service["name"]
+    service_type = service["type"]
+    service_map = service["map"]
+    result = {
+        "name":service_name,
+        "staged":False,
+        "unchanged":False,
+        "fingerprint":None,
+        "definition":None,
+        "counts":{},
+        "delta":None,
+        "footprints":None,
+        "upsert":False,
+        "pending":None,
+        "hash":None,
+        "path":None,
+        "package":None
+    }
+    if projects is None:
+        initProjectCache(getProjectCacheSettings({}))
+    try:
+        with timings.span("project load", service_name):
+            project = projects.getProject(service["project"])
+        Log("[PASS] Loaded project file for {}".format(service_name))
+    except:
+        Log("[FAIL] Failed to load project file for {}".format(service_name))
+        return result
+
+    try:
+        with timings.span("map lookup", service_name):
+            mapview = projects.getMap(service["project"], service_map)
+        Log("[PASS] Retrieved map for {}".format(service_name))
+    except:
+        Log("[FAIL] Failed to retrieve map for {}".format(service_name))
+        return result
+
+    if service_type == "FEATURE":
+        stageDefinition(service, mapview, staging, result, previous)
+    elif service_type == "UPSERT":
+        if checkFingerprint(service, mapview, result, previous):
+            return result
+        stageUpsert(service, mapview, staging, result)
+    elif service_type in ["REPLACEVECTORTILE", "REPLACETILE"]:
+        pk_name = "{}_{}".format(service_name, datetime.strftime(datetime.now(),'%Y%m%d_%H%M%S'))
+        pk_path = os.path.join(staging, "{}.{}".format(pk_name, "vtpk" if service_type == "REPLACEVECTORTILE" else "tpkx"))
+        result["package"] = pk_name
+        if checkFingerprint(service, mapview, result, previous) or reusePendingUpload(staging, service_name, result):
+            return result
+        try:
+            if service_type == "REPLACEVECTORTILE":
+                shards = getShardSettings(service)
+                # A sharded package records its own shard and merge spans
+                if not (shards["enabled"] and packageSharded(service, mapview, None, pk_path, shards)):
+                    with timings.span("packaging", service_name) as span:
+                        structure = service["parameters"]["tile_structure"] if "parameters" in service and "tile_structure" in service["parameters"] else "INDEXED"
+                        arcpy.management.CreateVectorTilePackage(mapview, pk_path, "ONLINE", "", structure, levelScale(VECTOR_LEVELS[0]), levelScale(VECTOR_LEVELS[1]))
+                        span["bytes"] = os.path.getsize(pk_path)
+                Log("[PASS] Generated Vector Tile Package {} for {}".format(pk_path, service_name))
+                if getIncrementalSettings(service)["enabled"]:
+                    Log("[INFO] Incremental updates are only available for REPLACETILE, rebuilt all vector tiles for {}".format(service_name))
+                result["path"] = pk_path
+                result["staged"] = True
+            elif service_type == "REPLACETILE":
+                aoi_layer = None
+                aoi_selectors = None
+                aoi_selector_layers = []
+                if "parameters" in service:
+                    aoi_layer = service["parameters"]["aoi"] if "aoi" in service["parameters"] else None
+                    aoi_selectors = service["parameters"]["aoi_selectors"] if "aoi_selectors" in service["parameters"] else None
+                    aoil = mapview.listLayers(aoi_layer)
+                    if len(aoil) == 1:
+                        aoi_layer = aoil[0]
+                    else:
+                        Log("[INFO] Failed to find AOI Layer: {}".format(aoi_layer))
+                        aoi_layer = None
+
+                    for aoi_selector in aoi_selectors:
+                        aois = mapview.listLayers(aoi_selector)
+                        if len(aois) == 1:
+                            aoi_selector_layers.append(aois[0])
+                        else:
+                            Log("[INFO] Failed to find AOI Selector: {}".format(aoi_selector))
+
+                if aoi_selector_layers:
+                    for i, aoi_selector_layer in enumerate(aoi_selector_layers):
+                        try:
+                            with timings.span("aoi selection", service_name):
+                                arcpy.management.SelectLayerByLocation(aoi_layer, "INTERSECT", aoi_selector_layer,selection_type=("NEW_SELECTION" if i == 0 else "ADD_TO_SELECTION"))
+                            Log("[INFO] Selecting AOI that intersects {}".format(aoi_selector_layers[i].name))
+                        except:
+                            Log("[FAIL] Failed to select AOI that intersects {}".format(aoi_selector_layers[i]))
+                            Log(arcpy.GetMessages())
+
+                if getIncrementalSettings(service)["enabled"]:
+                    delta = stageIncremental(service, mapview, aoi_layer, previous, result, pk_path)
+                    if delta is not None:
+                        return delta
+
+                Log("[INFO] Beginning Tile Package Generation for {} in {}".format(service_map, project.filePath))
+                try:
+                    shards = getShardSettings(service)
+                    if not (shards["enabled"] and packageSharded(service, mapview, aoi_layer, pk_path, shards)):
+                        with timings.span("packaging", service_name) as span:
+                            arcpy.management.CreateMapTilePackage(mapview, "ONLINE", pk_path, "PNG8", TILE_LEVELS[1], None, '', '', aoi_layer.name, 75, 'tpkx', TILE_LEVELS[0], aoi_layer)
+                            span["bytes"] = os.path.getsize(pk_path)
+                    Log("[PASS] Tile package generated successfully")
+                    result["path"] = pk_path
+                    result["staged"] = True
+                except:
+                    Log("[FAIL] Failed to generate tile package for {} in {}".format(service_map, project.filePath))
+                    Log(arcpy.GetMessages())
+        except:
+            Log("[FAIL] Failed to generate Tile Package for {}".format(service_name))
+            Log(arcpy.GetMessages())
+    return result
+
+def updateTiles(gis, service, staged, index):
+    # Incremental update of a hosted tile layer: the package of changed tiles is uploaded as
+    # an item, imported into the existing tile service and then removed again.
+    service_name = service["name"]
+    service_id = service["id"]
+    if staged["delta"]["empty"]:
+        return True
+    target = index.get(service_id) or index.refresh(service_id)
+    if not target:
+        Log("[FAIL] Target item {} for {} was not found".format(service_id, service_name))
+        return False
+    delta_path = staged["path"]
+    try:
+        properties = {
+            "type":"Compact Tile Package",
+            "title":"{}_delta".format(staged["package"]),
+            "tags":service["tags"],
+            "snippet":service["summary"]
+        }
+        delta = retrypolicy.transfer("upload", service_name, delta_path, gis.content.add, properties, data=delta_path, folder=service["portalfolder"] or None)
+        index.add(delta)
+        Log("[PASS] Uploaded changed tiles for {} as {}".format(service_name, delta.id))
+    except Exception as e:
+        Log("[FAIL] Failed to upload changed tiles for {}".format(service_name))
+        Log(e)
+        return False
+    updated = False
+    try:
+        manager = target.layers[0].manager
+        retrypolicy.call("import tiles", service_name, manager.import_tiles, delta, levels=staged["delta"]["levels"], extent=staged["delta"]["extent"], merge=True, replace=True)
+        Log("[PASS] Updated changed tiles of {}".format(service_name))
+        updated = True
+    except Exception as e:
+        Log("[FAIL] Failed to import changed tiles into {}".format(service_name))
+        Log(e)
+    try:
+        retrypolicy.call("delete", delta.title, delta.delete)
+        index.remove(delta.id)
+    except:
+        Log("[FAIL] Failed to delete uploaded tile package {}".format(delta.id))
+    try:
+        runTool(arcpy.management.Delete, delta_path)
+    except Exception as e:
+        Log("[FAIL] Failed to delete staging tile package, {}".format(delta_path))
+        Log(e)
+    return updated
+
+def applyEdits(layer, service_name, adds=None, updates=None, deletes=None):
+    results = retrypolicy.call("apply edits", service_name, layer.edit_features, adds=adds, updates=updates, deletes=deletes)
+    failed = 0
+    for kind in ["addResults", "updateResults", "deleteResults"]:
+        failed += len([edit for edit in results.get(kind, []) if not edit.get("success")])
+    return failed
+
+def upsertService(gis, service, staged, index):
+    # Pushes only the changed rows of each layer to the hosted feature layer: rows whose key
+    # is new are added, known keys are updated and hosted keys missing locally are deleted.
+    service_name = service["name"]
+    settings = getUpsertSettings(service)
+    key_field = settings["key_field"]
+    batch_size = max(1, int(settings["batch_size"]))
+    if "id" in service:
+        target = index.get(service["id"]) or index.refresh(service["id"])
+    else:
+        items = index.find(title=service_name, item_type="Feature Service")
+        target = items[0] if len(items) == 1 else None
+    if not target:
+        Log("[FAIL] Found no hosted feature layer to upsert {} into".format(service_name))
+        return False
+    with open(staged["path"], 'r') as f:
+        changes = json.load(f)
+    with open(staged["pending"], 'r') as f:
+        pending = json.load(f)
+    try:
+        hosted = {layer.properties.name:layer for layer in target.layers}
+    except Exception as e:
+        Log("[FAIL] Failed to read the layers of {}".format(service_name))
+        Log(e)
+        return False
+
+    jobs = []
+    with ThreadPoolExecutor(max_workers=max(1, int(settings["max_workers"]))) as editors:
+        for name, layer in changes["layers"].items():
+            if name not in hosted:
+                Log("[FAIL] The hosted layer of {} has no layer {}".format(service_name, name))
+                return False
+            target_layer = hosted[name]
+            try:
+                oid_field = target_layer.properties.objectIdField
+                features = retrypolicy.call("hosted keys", service_name, target_layer.query, where="1=1", out_fields="{},{}".format(key_field, oid_field), return_geometry=False, return_all_records=True).features
+            except Exception as e:
+                Log("[FAIL] Failed to query the hosted keys of {} in {}".format(name, service_name))
+                Log(e)
+                return False
+            keys = {str(feature.attributes[key_field]):feature.attributes[oid_field] for feature in features}
+            adds = []
+            updates = []
+            for feature in layer["changes"]:
+                key = str(feature["attributes"][key_field])
+                if key in keys:
+                    feature["attributes"][oid_field] = keys[key]
+                    updates.append(feature)
+                else:
+                    adds.append(feature)
+            local = set(layer["keys"])
+            deletes = [str(oid) for key, oid in keys.items() if key not in local]
+            # Rows deleted on the portal but unchanged locally aren't in the change set, forget
+            # their hashes so they are pushed as adds next time
+            changed = set(str(feature["attributes"][key_field]) for feature in layer["changes"])
+            missing = [key for key in local if key not in keys and key not in changed]
+            for key in missing:
+                pending["layers"][name].pop(key, None)
+            if missing:
+                Log("[INFO] {} rows of {} are missing from the hosted layer and will be added next run".format(str(len(missing)), name))
+            Log("[INFO] Upserting {}: {} adds, {} updates, {} deletes".format(name, str(len(adds)), str(len(updates)), str(len(deletes))))
+            for start in range(0, len(adds), batch_size):
+                jobs.append(editors.submit(applyEdits, target_layer, service_name, adds=adds[start:start + batch_size]))
+            for start in range(0, len(updates), batch_size):
+                jobs.append(editors.submit(applyEdits, target_layer, service_name, updates=updates[start:start + batch_size]))
+            for start in range(0, len(deletes), batch_size):
+                jobs.append(editors.submit(applyEdits, target_layer, service_name, deletes=",".join(deletes[start:start + batch_size])))
+
+    failed = 0
+    for job in jobs:
+        try:
+            failed += job.result()
+        except Exception as e:
+            Log("[FAIL] An edit batch for {} failed".format(service_name))
+            Log(e)
+            return False
+    if failed:
+        Log("[FAIL] {} edits to {} were rejected".format(str(failed), service_name))
+        return False
+    with open(staged["pending"], 'w') as f:
+        json.dump(pending, f)
+    index.refresh(target.id)
+    Log("[PASS] Successfully upserted service {}".format(service_name))
+    return True
+
+def publishService(gis, service, staged, username, password, index):
+    # Network (Portal) half of a service update. Returns True when the hosted layer was
+    # successfully updated so the caller can record sync.last.
+    service_name = service["name"]
+    service_type = service["type"]
+    service_folder = service["portalfolder"]
+    service_sharing = service["sharing"]
+
+    if service_type == "UPSERT" and staged["upsert"]:
+        return upsertService(gis, service, staged, index)
+    if service_type in ["FEATURE", "UPSERT"]:
+        service_sd = staged["path"]
+        Log("[INFO] Searching for existing Service Definition")
+        items = index.find(title=service_name, item_type="Service Definition")
+        Log("[INFO] Found {} matching Service Definitions".format(str(len(items))))
+        if len(items) == 0:
+            Log("[FAIL] Found no matching Service Definition for {}".format(service_name))
+            return False
+        if len(items) > 1:
+            Log("[FAIL] Found more than one matching Service Definition for {}".format(service_name))
+            return False
+        sditem = items[0]
+        Log("[PASS] Found existing Service Definition for {} ({})".format(service_name, sditem.id))
+        try:
+            Log("[INFO] Attempting to overwrite existing Feature Service Definition for {}".format(service_name))
+            stagingcache.update(gis, sditem, service_sd, staged["hash"], service_name, staged["fingerprint"])
+            fs = retrypolicy.call("publish", service_name, sditem.publish, overwrite=True)
+            Log("[PASS] Successfully overwrote existing Feature Service Definition for {}".format(service_name))
+        except Exception as e:
+            Log("[FAIL] Failed to overwrite existing Feature Service Defintion for {}".format(service_name))
+            Log(e)
+            return False
+        index.add(fs)
+        index.refresh(sditem.id)
+        try:
+            Log("[INFO] Updating sharing on {}".format(service_name))
+            retrypolicy.call("share", service_name, fs.share, org=service_sharing["org"], everyone=service_sharing["public"], groups=service_sharing["groups"])
+            Log("[PASS] Updated sharing on {}".format(service_name))
+            Log("[PASS] Successfully processed service {}".format(service_name))
+            return True
+        except:
+            Log("[FAIL] Failed to update sharing on {}".format(service_name))
+        return False
+    elif service_type in ["REPLACEVECTORTILE", "REPLACETILE"] and staged["delta"]:
+        return updateTiles(gis, service, staged, index)
+    elif service_type in ["REPLACEVECTORTILE", "REPLACETILE"]:
+        service_summary = service["summary"]
+        service_tags = service["tags"]
+        service_id = service["id"]
+        service_public = "EVERYBODY" if service_sharing["public"] == True else "MYGROUPS"
+        pk_name = staged["package"]
+        pk_path = staged["path"]
+        if not (index.get(service_id) or index.refresh(service_id)):
+            Log("[FAIL] Target item {} for {} was not found in the content of {}".format(service_id, service_name, username))
+            return False
+        if not ("force" in service and service["force"]) and stagingcache.isUploaded(service_id, staged["fingerprint"]):
+            # A run that stopped after the replace but before recording the fingerprint
+            Log("[SKIP] {} was already replaced with a package of the same source".format(service_name))
+            return True
+        if stagingcache.chunked:
+            # Resumable upload of the package, then publish and share it from the uploaded item
+            properties = {
+                "type":"Vector Tile Package" if service_type == "REPLACEVECTORTILE" else "Compact Tile Package",
+                "title":pk_name,
+                "tags":service_tags,
+                "snippet":service_summary
+            }
+            try:
+                folderid = index.folders.get(service_folder) if service_folder else None
+                package = index.refresh(stagingcache.add(gis, username, pk_path, staged["hash"], service_name, properties, folderid, staged["fingerprint"]))
+                published = retrypolicy.call("publish", service_name, package.publish)
+                service_item = published.id
+                Log("[PASS] Successfully published {} Package. ItemID {}".format("Vector Tile" if service_type == "REPLACEVECTORTILE" else "Tile", package.id))
+                retrypolicy.call("share", service_name, published.share, org=service_sharing["org"], everyone=service_sharing["public"], groups=service_sharing["groups"])
+            except Exception as e:
+                Log("[FAIL] Failed to publish Tile Package")
+                Log(e)
+                return False
+        else:
+            try:
+                publish = retrypolicy.transfer("share package", service_name, pk_path, runTool, arcpy.management.SharePackage, pk_path, username, password, service_summary, service_tags, public=service_public, groups=service_sharing["groups"], publish_web_layer="TRUE", portal_folder=service_folder)
+                Log("[PASS] Successfully published {} Package. ItemID {}".format("Vector Tile" if service_type == "REPLACEVECTORTILE" else "Tile", publish[2]))
+                publish_result = json.loads(publish[1])
+                service_item = publish_result["publishResult"]["serviceItemId"]
+                index.refresh(publish[2])
+            except Exception as e:
+                # arcpy errors carry the messages of their tool, GetMessages() could belong
+                # to a tool run by another thread
+                Log("[FAIL] Failed to publish Tile Package")
+                Log(e)
+                return False
+        try:
+            retrypolicy.poll("publish job", service_name, lambda: itemReady(gis, service_item))
+            index.refresh(service_item)
+        except Exception as e:
+            Log("[FAIL] Published service {} for {} did not become ready".format(service_item, service_name))
+            Log(e)
+            return False
+        Log("[INFO] Attempting to replace Tiles for {} with {}".format(service_name, pk_name))
+        try:
+            replaced = retrypolicy.call("replace", service_name, gis.content.replace_service, service_id, service_item, replace_metadata=False)
+            Log("[PASS] Successfully replaced {} Service {} with {}".format("Vector Tile" if service_type == "REPLACEVECTORTILE" else "Tile", service_name, pk_name))
+            index.refresh(service_id)
+            index.refresh(service_item)
+            stagingcache.markUploaded(service_id, staged["fingerprint"])
+        except Exception as e:
+            Log("[FAIL] Failed to replace Tile Service {} with {}".format(service_name, pk_name))
+            Log(e)
+            return False
+        try:
+            runTool(arcpy.management.Delete, pk_path)
+            Log("[PASS] Deleted staging tile package")
+        except Exception as e:
+            Log("[FAIL] Failed to delete staging tile package, {}".format(pk_path))
+            Log(e)
+        return True
+    return False
+
+def stageInWorker(service, staging, previous=None):
+    # Entry point of the staging processes, hands the worker's spans and log lines back
+    try:
+        staged = stageService(service, staging, previous)
+        staged["spans"] = timings.drain()
+        return staged
+    finally:
+        Log.flush()
+
+def getDueServices(services):
+    due = []
     for service in services:
         Log("[INFO] Processing service {}".format(service["name"]))
         service_name = service["name"]
         service_type = service["type"]
-        service_folder = service["portalfolder"]
         service_process = service["process"]
-        service_sharing = service["sharing"]
-        service_update = getSync(service["sync"])
-        service_sddraft = os.path.join(staging, "{}.sddraft".format(service_name))
-        service_sd = os.path.join(staging,"{}.sd".format(service_name))
-        if service_update["last"] <= (datetime.now() + service_update["frequency"]):
+        if isDue(service["sync"]):
             if service_process:
-                if service_type in ["FEATURE", "REPLACEVECTORTILE", "REPLACETILE"]:
-                    service_map = service["map"]
-                    try:
-                        Log("[PASS] Loaded project file for {}".format(service_name))
-                        project = arcpy.mp.ArcGISProject(service["project"])
-                    except:
-                        Log("[FAIL] Failed to load project file for {}".format(service_name))
-                        project = None
-                    if project:
-                        try:
-                            mapview = project.listMaps(service_map)[0]
-                            Log("[PASS] Retrieved map for {}".format(service_name))
-                        except:
-                            Log("[FAIL] Failed to retrieve map for {}".format(service_name))
-                            mapview = None
-
-                        if mapview:
-                            if service_type == "FEATURE":
-                                try:
-                                    draft = mapview.getWebLayerSharingDraft("HOSTING_SERVER", service_type, service_name)
-                                    draft.exportToSDDraft(service_sddraft)
-                                    Log("[PASS] Created Draft Service Definition for {}".format(service_name))
-                                    try:
-                                        arcpy.StageService_server(service_sddraft, service_sd)
-                                        Log("[PASS] Staged Service {}".format(service_name))
-                                        try:
-                                            items = gis.content.search("{} AND owner:{}".format(service_name, username), item_type="Service Definition")
-                                            Log("[INFO] Searching for existing Service Definition")
-                                            Log("[INFO] Found {} matching Service Definitions".format(str(len(items))))
-                                            if len(items) == 1:
-                                                sditem = items[0]
-                                                Log("[PASS] Found existing Service Definition for {} ({})".format(service_name, sditem.id))
-                                                attempts = 0
-                                                while True:
-                                                    try:
-                                                        attempts += 1
-                                                        Log("[INFO] Attempting to overwrite existing Feature Service Definition for {}".format(service_name))
-                                                        sditem.update(data=service_sd)
-                                                        fs = sditem.publish(overwrite=True)
-                                                        Log("[PASS] Successfully overwrote existing Feature Service Definition for {}".format(service_name))
-                                                        try:
-                                                            Log("[INFO] Updating sharing on {}".format(service_name))
-                                                            fs.share(org=service_sharing["org"], everyone=service_sharing["public"], groups=service_sharing["groups"])
-                                                            Log("[PASS] Updated sharing on {}".format(service_name))
-                                                            Log("[PASS] Successfully processed service {}".format(service_name))
-                                                            service["sync"]["last"] = datetime.now().strftime("%Y-%m-%d")
-                                                        except:
-                                                            Log("[FAIL] Failed to update sharing on {}".format(service_name))                                        
-                                                    except Exception as e:
-                                                        Log("[FAIL] Failed to overwrite existing Feature Service Defintion for {} [Attempts: {}]".format(service_name, str(attempts)))
-                                                        if attempts < retrylimit:
-                                                            Log(e)
-                                                    break
-                                            else:
-                                                Log("[FAIL] Found more than one matching Service Definition for {}".format(service_name))
-                                        except:
-                                            Log("[FAIL] Failed to search for existing Service Definition")
-                                    except:
-                                        Log("[FAIL] Failed to Stage Service {}".format(service_name))
-                                except Exception as e:
-                                    Log("[FAIL] Failed to create Draft Service Definition for {}".format(service_name))
-                                    Log(arcpy.GetMessages())
-                                    Log(e)
-                            elif service_type in ["REPLACEVECTORTILE", "REPLACETILE"]:
-                                service_summary = service["summary"]
-                                service_tags = service["tags"]
-                                service_id = service["id"]
-                                service_sharing = service["sharing"]
-                                service_public = "EVERYBODY" if service_sharing["public"] == True else "MYGROUPS"
-
-                                pk_name = "{}_{}".format(service_name, datetime.strftime(datetime.now(),'%Y%m%d_%H%M%S'))
-                                pk_path = os.path.join(staging, "{}.{}".format(pk_name, "vtpk" if service_type == "REPLACEVECTORTILE" else "tpkx"))
-                                mapview.clearSelection()
-                                try:
-                                    if service_type == "REPLACEVECTORTILE":
-                                        arcpy.management.CreateVectorTilePackage(mapview, pk_path, "ONLINE", "", "INDEXED", 577790.554288, 282.124294)
-                                        Log("[PASS] Generated Vector Tile Package {} for {}".format(pk_path, service_name))
-                                        Log("[INFO] Attempting to publish Vector Tile Package")
-                                    elif service_type == "REPLACETILE":
-                                        aoi_layer = None
-                                        aoi_selectors = None
-                                        aoi_selector_layers = []
-                                        if "parameters" in service:
-                                            aoi_layer = service["parameters"]["aoi"] if "aoi" in service["parameters"] else None
-                                            aoi_selectors = service["parameters"]["aoi_selectors"] if "aoi_selectors" in service["parameters"] else None
-                                            aoil = mapview.listLayers(aoi_layer)
-                                            if len(aoil) == 1:
-                                                aoi_layer = aoil[0]
-                                            else:
-                                                Log("[INFO] Failed to find AOI Layer: {}".format(aoi_layer))
-                                                aoi_layer = None
-
-                                            for aoi_selector in aoi_selectors:                                                
-                                                aois = mapview.listLayers(aoi_selector)
-                                                if len(aois) == 1:
-                                                    aoi_selector_layers.append(aois[0])
-                                                else:
-                                                    Log("[INFO] Failed to find AOI Selector: {}".format(aoi_selector))
-
-                                        if aoi_selector_layers:
-                                            for i, aoi_selector_layer in enumerate(aoi_selector_layers):
-                                                try:
-                                                    arcpy.management.SelectLayerByLocation(aoi_layer, "INTERSECT", aoi_selector_layer,selection_type=("NEW_SELECTION" if i == 0 else "ADD_TO_SELECTION"))
-                                                    Log("[INFO] Selecting AOI that intersects {}".format(aoi_selector_layers[i].name))
-                                                except:
-                                                    Log("[FAIL] Failed to select AOI that intersects {}".format(aoi_selector_layers[i]))
-                                                    Log(arcpy.GetMessages())
-
-                                        Log("[INFO] Beginning Tile Package Generation for {} in {}".format(service_map, project.filePath))
-                                        try:
-                                            arcpy.management.CreateMapTilePackage(mapview, "ONLINE", pk_path, "PNG8", 21, None, '', '', aoi_layer.name, 75, 'tpkx', 19, aoi_layer)
-                                            Log("[PASS] Tile package generated successfully")
-                                        except:
-                                            Log("[FAIL] Failed to generate tile package for {} in {}".format(service_map, project.filePath))
-                                            Log(arcpy.GetMessages())                                        
-                                            
-                                    try:
-                                        publish = arcpy.management.SharePackage(pk_path, username, password, service_summary, service_tags, public=service_public, groups=service_sharing["groups"], publish_web_layer="TRUE", portal_folder=service_folder)
-                                        Log("[PASS] Successfully published {} Package. ItemID {}".format("Vector Tile" if service_type == "REPLACEVECTORTILE" else "Tile", publish[2]))
-                                        Log("[INFO] Attempting to replace Tiles for {} with {}".format(service_name, pk_name))
-                                        publish_result = json.loads(publish[1])
-                                        sleep(10)
-                                        try:
-                                            replaced = gis.content.replace_service(service_id, publish_result["publishResult"]["serviceItemId"], replace_metadata=False)
-                                            Log("[PASS] Successfully replaced {} Service {} with {}".format("Vector Tile" if service_type == "REPLACEVECTORTILE" else "Tile", service_name, pk_name))
-                                            service["sync"]["last"] = datetime.now().strftime("%Y-%m-%d")
-                                            try:
-                                                arcpy.management.Delete(pk_path)
-                                                Log("[PASS] Deleted staging tile package")
-                                            except:
-                                                Log("[FAIL] Failed to delete staging tile package, {}".format(pk_path))
-                                                Log(arcpy.GetMessages())
-                                        except Exception as e:
-                                            Log("[FAIL] Failed to replace Tile Service {} with {}".format(service_name, pk_name))
-                                            Log(arcpy.GetMessages())
-                                            Log(e)
-                                    except:
-                                        Log("[FAIL] Failed to publish Tile Package")
-                                        Log(arcpy.GetMessages())
-                                except:
-                                    Log("[FAIL] Failed to generate Tile Package for {}".format(service_name))
-                                    Log(arcpy.GetMessages())
-                            else:
-                                Log("[FAIL] Service Type, {}, not implemented".format(service_type))
-                        else:
-                            Log("[FAIL] Failed to retrieve map for {}".format(service_name))
-                    else:
-                        Log("[FAIL] Failed to load project file for {}".format(service_name))
+                if service_type in ["FEATURE", "UPSERT", "REPLACEVECTORTILE", "REPLACETILE"]:
+                    due.append(service)
                 else:
-                    Log("[FAIL] Service Type, {}, not implemented".format(service_type))                
+                    Log("[FAIL] Service Type, {}, not implemented".format(service_type))
             else:
                 Log("[INFO] Skipped {} - not flagged for processing".format(service_name))
         else:
             Log("[SKIP] Skipped {} because not time to update yet".format(service_name))
+    return due
+
+def markSynced(service):
+    service["sync"]["last"] = datetime.now().strftime("%Y-%m-%d")
+
+def markPublished(service, staged, fingerprints):
+    # The fingerprint is only remembered once the publish succeeded, a failed publish is retried next run
+    markSynced(service)
+    if staged["pending"]:
+        os.replace(staged["pending"], getUpsertState(service)[0])
+    if staged["fingerprint"]:
+        fingerprints[service["name"]] = {"fingerprint":staged["fingerprint"], "definition":staged["definition"], "counts":staged["counts"]}
+        if staged["footprints"] is not None:
+            fingerprints[service["name"]]["footprints"] = staged["footprints"]
+
+def assignLanes(due, workers):
+    # Splits the services into one lane per staging process. All services of a project go
+    # to the same lane so each .aprx is opened by a single process, the largest projects are
+    # handed out first to the lane with the fewest services.
+    groups = OrderedDict()
+    for service in due:
+        groups.setdefault(os.path.normcase(os.path.abspath(service["project"])), []).append(service)
+    lanes = [[] for i in range(max(1, min(workers, len(groups))))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(lanes, key=len).extend(group)
+    return lanes
+
+def processServices(gis, services, staging, username, password, pipeline, fingerprints, cache_settings, index):
+    # Grouping services by project lets each project be opened once per process
+    due = sorted(getDueServices(services), key=lambda service: os.path.normcase(os.path.abspath(service["project"])))
+    if not pipeline["enabled"]:
+        initProjectCache(cache_settings)
+        for service in due:
+            try:
+                staged = stageService(service, staging, fingerprints.get(service["name"]))
+            except Exception as e:
+                Log("[FAIL] Failed to stage {}".format(service["name"]))
+                Log(e)
+                continue
+            if staged["unchanged"]:
+                markSynced(service)
+                continue
+            try:
+                if staged["staged"] and publishService(gis, service, staged, username, password, index):
+                    markPublished(service, staged, fingerprints)
+            except Exception as e:
+                Log("[FAIL] Failed to publish {}".format(service["name"]))
+                Log(e)
+        return
+
+    Log("[INFO] Pipeline enabled with {} staging and {} portal workers".format(str(pipeline["staging_workers"]), str(pipeline["portal_workers"])))
+    # Services are staged in worker processes and handed to the Portal thread pool as soon
+    # as they finish, so uploads overlap with the staging of the remaining services. Each
+    # staging process has a lane of its own, a ProcessPoolExecutor can't be told which
+    # worker runs a job. Results come back as copies, sync bookkeeping is always applied to
+    # the original config entry.
+    lanes = assignLanes(due, pipeline["staging_workers"])
+    stagers = [None] * len(lanes)
+    staging_jobs = {}
+    crashes = {}
+
+    def startLane(lane):
+        stagers[lane] = ProcessPoolExecutor(max_workers=1, initializer=initWorker, initargs=(cache_settings,))
+        for service in lanes[lane]:
+            staging_jobs[stagers[lane].submit(stageInWorker, service, staging, fingerprints.get(service["name"]))] = (lane, service)
+
+    def restartLane(lane):
+        # A lane runs its services in order, so the first one not finished is the one that
+        # took the process down. It is given up on after crashing the lane twice, the rest are
+        # resubmitted to a new process.
+        for job in [job for job in staging_jobs if staging_jobs[job][0] == lane]:
+            del staging_jobs[job]
+        stagers[lane].shutdown(wait=False)
+        culprit = lanes[lane][0]
+        crashes[culprit["name"]] = crashes.get(culprit["name"], 0) + 1
+        if crashes[culprit["name"]] >= 2:
+            Log("[FAIL] Staging {} crashed the worker process {} times, giving up on it".format(culprit["name"], str(crashes[culprit["name"]])))
+            lanes[lane].pop(0)
+        else:
+            Log("[INFO] Staging worker crashed while staging {}, restarting it".format(culprit["name"]))
+        if lanes[lane]:
+            startLane(lane)
+
+    try:
+        with ThreadPoolExecutor(max_workers=pipeline["portal_workers"]) as publishers:
+            for lane in range(len(lanes)):
+                startLane(lane)
+            publish_jobs = {}
+            while staging_jobs:
+                done = wait(staging_jobs, return_when=FIRST_COMPLETED)[0]
+                broken = set()
+                for job in done:
+                    lane, service = staging_jobs[job]
+                    try:
+                        staged = job.result()
+                    except BrokenProcessPool:
+                        broken.add(lane)
+                        continue
+                    except Exception as e:
+                        Log("[FAIL] Staging worker failed for {}".format(service["name"]))
+                        Log(e)
+                        staged = None
+                    del staging_jobs[job]
+                    lanes[lane].remove(service)
+                    if staged is None:
+                        continue
+                    timings.extend(staged.pop("spans"))
+                    if staged["unchanged"]:
+                        markSynced(service)
+                    elif staged["staged"]:
+                        publish_jobs[publishers.submit(publishService, gis, service, staged, username, password, index)] = (service, staged)
+                # Results that finished before the crash are handled above, so what is left of
+                # a broken lane is the crashed service and the ones queued behind it
+                for lane in broken:
+                    restartLane(lane)
+            for job in as_completed(publish_jobs):
+                service, staged = publish_jobs[job]
+                try:
+                    if job.result():
+                        markPublished(service, staged, fingerprints)
+                except Exception as e:
+                    Log("[FAIL] Portal worker failed for {}".format(service["name"]))
+                    Log(e)
+    finally:
+        for stager in stagers:
+            if stager:
+                stager.shutdown()
+
+def searchItems(gis, query, page_size=100, before=None):
+    # Pages through a portal search without holding the full result set in memory. Pages
+    # follow the created date instead of an offset, CLEAN deletes items while it pages and
+    # every delete would shift the later pages of an offset. The lower bound is inclusive so
+    # items created in the same millisecond as the last one seen aren't lost, the ones
+    # already returned are skipped.
+    upper = "{:019d}".format(before) if before is not None else "9" * 19
+    after = 0
+    start = 1
+    seen = set()
+    while True:
+        page = retrypolicy.call("search", query, gis.content.advanced_search, query="{} created:[{:019d} TO {}]".format(query, after, upper), max_items=page_size, start=start, sort_field="created", sort_order="asc")
+        results = page["results"]
+        for item in results:
+            if item.id not in seen:
+                yield item
+        if not results or page["nextStart"] is None or page["nextStart"] < 1:
+            break
+        last = results[-1].created
+        if last != after:
+            after, start, seen = last, 1, set()
+        else:
+            # A whole page created in the same millisecond, only an offset gets past it
+            start = page["nextStart"]
+        seen.update(item.id for item in results if item.created == last)
+
+def findCleanCandidates(gis, task, indexes, checkpoint):
+    search_string = task['find']
+    owner = task['owner'] if 'owner' in task else None
+    content_type = task['content_type'] if 'content_type' in task else None
+    folder = task['folder'] if 'folder' in task else None
+    older_than = task['olderthan'] if 'olderthan' in task else 7
+
+    if owner:
+        results = getContentIndex(gis, owner, indexes).match(search_string, content_type, folder)
+    else:
+        # The age cutoff is pushed into the query, the portal expects 19 digit epoch milliseconds
+        cutoff = int(checkpoint.timestamp() * 1000)
+        query = "title:{}".format(search_string)
+        if content_type:
+            query += " type:{}".format(content_type)
+        query += " modified:[0000000000000000000 TO {:019d}]".format(cutoff)
+        results = searchItems(gis, query, before=cutoff)
+
+    for result in results:
+        if result.title.startswith(search_string):
+            modified_date = datetime.fromtimestamp(result.modified/1000)
+            created_date = datetime.fromtimestamp(result.created/1000)
+            if modified_date < checkpoint and created_date < checkpoint:
+                Log("[INFO] {} is older than {} days, attempting to delete".format(result.title, str(older_than)))
+                if not result.can_delete:
+                    Log("[INFO] {} is delete protected".format(result.title))
+                else:
+                    yield result
+            else:
+                Log("[INFO] {} is not older than {}, keeping".format(result.title, str(older_than)))
+        else:
+            Log("[INFO] {} does not begin with {}, skipping".format(result.title, search_string))
+
+def deleteItem(item, dry_run):
+    if dry_run:
+        try:
+            deleted = retrypolicy.call("delete", item.title, item.delete, dry_run=True)
+        except Exception as e:
+            Log("[FAIL] Failed to check if {} can be deleted".format(item.title))
+            Log(e)
+            return False
+        if deleted['can_delete']:
+            Log("[INFO] DRYRUN {} would be deleted".format(item.title))
+            return True
+        Log("[INFO] DRYRUN {} can not be deleted".format(item.title))
+        return False
+    Log("[INFO] DELETE {}".format(item.title))
+    try:
+        if not retrypolicy.call("delete", item.title, item.delete):
+            Log("[FAIL] The portal did not delete {}".format(item.title))
+            return False
+        Log("[PASS] DELETED {} successfully".format(item.title))
+        return True
+    except Exception as e:
+        Log("[FAIL] Failed to Delete {}".format(item.title))
+        Log(e)
+        return False
+
+def deleteBatch(gis, batch, dry_run):
+    # Uses the bulk delete of the Python API where it exists, a batch that fails as a
+    # whole is retried item by item so every item still gets its own result.
+    if not dry_run and hasattr(gis.content, "delete_items"):
+        try:
+            if retrypolicy.call("delete", "{} items".format(str(len(batch))), gis.content.delete_items, items=batch):
+                for item in batch:
+                    Log("[PASS] DELETED {} successfully".format(item.title))
+                return [item.id for item in batch]
+        except Exception as e:
+            Log("[INFO] Bulk delete of {} items failed, deleting individually".format(str(len(batch))))
+            Log(e)
+    return [item.id for item in batch if deleteItem(item, dry_run)]
+
+def cleanItems(gis, task, indexes):
+    summary = task['summary']
+    older_than = task['olderthan'] if 'olderthan' in task else 7
+    owner = task['owner'] if 'owner' in task else None
+    dry_run = task['dry_run'] if 'dry_run' in task else False
+    max_deletes = task['max_deletes'] if 'max_deletes' in task else 0
+    workers = max(1, int(task['workers'])) if 'workers' in task else 1
+    batch_size = max(1, int(task['batch_size'])) if 'batch_size' in task else 1
+    checkpoint = datetime.now() - relativedelta.relativedelta(days=older_than)
+
+    found = 0
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=workers) as deleters:
+        # Candidates are streamed into the pool, at most two batches per worker are in flight
+        inflight = threading.BoundedSemaphore(workers * 2)
+        jobs = []
+        batch = []
+        def submit(batch):
+            inflight.acquire()
+            job = deleters.submit(deleteBatch, gis, batch, dry_run)
+            job.add_done_callback(lambda job: inflight.release())
+            jobs.append(job)
+        for candidate in findCleanCandidates(gis, task, indexes, checkpoint):
+            if max_deletes and found >= max_deletes:
+                Log("[INFO] Reached max_deletes of {} for {}, remaining items are kept".format(str(max_deletes), summary))
+                break
+            found += 1
+            batch.append(candidate)
+            if len(batch) >= batch_size:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+        for job in jobs:
+            try:
+                removed = job.result()
+            except Exception as e:
+                Log("[FAIL] Delete worker failed for {}".format(summary))
+                Log(e)
+                continue
+            deleted += len(removed)
+            if owner and not dry_run:
+                for itemid in removed:
+                    indexes[owner.lower()].remove(itemid)
+
+    if dry_run:
+        Log("[INFO] DRYRUN {}: {} items matched, {} would be deleted".format(summary, str(found), str(deleted)))
+    else:
+        Log("[INFO] {}: {} items matched, {} deleted".format(summary, str(found), str(deleted)))
+    return found, deleted
+
+def runTasks(gis, tasks, indexes):
     for task in tasks:
         if task['type'] in ['CLEAN']:
             search_string = task['find'] if 'find' in task else None
-            older_than = task['olderthan'] if 'olderthan' in task else 7
-            owner = task['owner'] if 'owner' in task else None
-            process = task['process'] if 'process' in task else False
             update = getSync(task['sync']) if 'sync' in task else None
             summary = task['summary']
-            content_type = task['content_type'] if 'content_type' in task else None
-            folder = task['folder'] if 'folder' in task else None
+            dry_run = task['dry_run'] if 'dry_run' in task else False
 
             if search_string and update:
-                if update["last"] <= (datetime.now() + update["frequency"]):
+                if isDue(task['sync']):
                     try:
-                        if owner and content_type:
-                            results = gis.content.search(query="title:{} type:{} owner:{}".format(search_string, content_type, owner), max_items=-1) 
-                        elif owner and not content_type:
-                            results = gis.content.search(query="title:{} owner:{}".format(search_string, owner), max_items=-1) 
-                        elif content_type and not owner:
-                            results = gis.content.search(query="title:{} type:{}".format(search_string, content_type), max_items=-1)
-                        else:
-                            results = gis.content.search(query="title:{}".format(search_string), max_items=-1)                         
-
-                        Log("[INFO] Found {} items that match the query {}".format(str(len(results)),search_string))
-                        if len(results) > 0:
-                            checkpoint = datetime.now() - relativedelta.relativedelta(days=older_than)
-                            for result in results:
-                                if result.title.startswith(search_string):
-                                    modified_date = datetime.fromtimestamp(result.modified/1000)
-                                    created_date = datetime.fromtimestamp(result.created/1000)
-                                    if modified_date < checkpoint and created_date < checkpoint:
-                                        Log("[INFO] {} is older than {} days, attempting to delete".format(result.title, str(older_than)))
-                                        if not result.can_delete:
-                                            Log("[INFO] {} is delete protected".format(result.title))
-                                        else:
-                                            Log("[INFO] DELETE {}".format(result.title))
-                                            deleted = result.delete(dry_run=True)
-                                            if deleted['can_delete']:
-                                                try:
-                                                    result.delete()
-                                                    Log("[PASS] DELETED {} successfully".format(result.title))
-                                                except Exception as e:
-                                                    Log("[FAIL] Failed to Delete {}".format(result.title))
-                                                    Log(e)
-                                    else:
-                                        Log("[INFO] {} is not older than {}, keeping".format(result.title, str(older_than)))
-                                else:
-                                    Log("[INFO] {} does not begin with {}, skipping".format(result.title, search_string))
-                            task["sync"]["last"] = datetime.now().strftime("%Y-%m-%d")
-                        else:
+                        found, deleted = cleanItems(gis, task, indexes)
+                        if found == 0:
                             Log("[INFO] No results found for query {}".format(search_string))
-                    except:
+                        if not dry_run:
+                            task["sync"]["last"] = datetime.now().strftime("%Y-%m-%d")
+                    except Exception as e:
                         Log("[FAIL] Failed to search for {}".format(search_string))
+                        Log(e)
                 else:
                     Log("[INFO] Skipping, {}, because not time to run yet".format(summary))
-                
+
             else:
                 if not search_string:
                     Log("[FAIL] No search string specified in find for {}".format(summary))
                 if not update:
                     Log("[FAIL] No update frequency set for {}".format(summary))
 
+def isTaskDue(task):
+    return task['type'] in ['CLEAN'] and 'find' in task and 'sync' in task and isDue(task['sync'])
+
+def isServiceDue(service):
+    return service["process"] and isDue(service["sync"])
+
+def loadConfig(configFile):
+    if not os.path.exists(configFile):
+        Log("[FAIL] No configuration file exists. Halting.")
+        exit(1)
+
+    with open(configFile, 'r') as f:
+        config = json.load(f)
+        Log("[PASS] Loaded configuration")
+
+    encrypted = config["encrypted"] if "encrypted" in config else None
+    if not encrypted:
+        config["password"] = encode("shenannigans", config["password"])
+        config["encrypted"] = True
+    return config
+
+def saveConfig(configFile, config):
+    Log("[INFO] Writing File")
+    with open(configFile, 'w') as f:
+        json.dump(config, f, indent=4, separators=(',',':'), sort_keys=True)
+
+class Session:
+    # One authenticated Portal connection, reconnected once it is older than the configured
+    # number of minutes or stops answering, so long running processes keep a valid token.
+    def __init__(self, config):
+        self.config = config
+        self.minutes = config["daemon"]["session_minutes"] if "daemon" in config and "session_minutes" in config["daemon"] else 60
+        self.gis = None
+        self.connected = None
+
+    def connect(self):
+        importArcGIS()
+        if self.gis and (datetime.now() - self.connected).total_seconds() < self.minutes * 60:
+            try:
+                self.gis.users.me
+                return self.gis
+            except Exception as e:
+                Log("[INFO] Portal session stopped answering, reconnecting")
+                Log(e)
+        try:
+            self.gis = GIS(self.config["portal"], self.config["username"], decode("shenannigans", self.config["password"]))
+            self.connected = datetime.now()
+            Log("[PASS] Connected to Portal")
+        except:
+            Log("[FAIL] Failed to Connect to Portal")
+            self.gis = None
+        return self.gis
+
+def runJobs(session, config, services, tasks):
+    # Runs one batch of services and tasks and records the results, shared by the one-shot
+    # and the daemon mode
+    started = datetime.now()
+    username = config["username"]
+    password = decode("shenannigans", config["password"])
+    retrylimit = config["retrylimit"] if config["retrylimit"] > 0 else 1
+    retrypolicy.configure(**getRetrySettings(config, retrylimit))
+    pipeline = getPipeline(config)
+    cache_settings = getProjectCacheSettings(config)
+    staging = os.path.join(sys.path[0], "staging")
+    fingerprintFile = os.path.join(sys.path[0], "fingerprints.json")
+    fingerprints = loadFingerprints(fingerprintFile)
+
+    Log("[INFO] {} services to update".format(str(len(services))))
+    Log("[INFO] Retry limit set to {}".format(str(retrylimit)))
+    Log("[INFO] Staging {}".format(staging))
+
+    if not os.path.exists(staging):
+        try:
+            os.mkdir(staging)
+            Log("[INFO] Created a staging folder")
+        except:
+            Log("[FAIL] Failed to create a staging folder")
+            return
+    stagingcache.configure(staging, **getUploadSettings(config))
+
+    gis = session.connect()
+    if not gis:
+        return
+    arcpy.env.overwriteOutput = True
+
+    indexes = {}
+    try:
+        index = getContentIndex(gis, username, indexes)
+    except Exception as e:
+        # Services look up their items in the index, tasks can still run without it
+        Log("[FAIL] Failed to index the content of {}, the services are retried next run".format(username))
+        Log(e)
+        index = None
+
+    if index is not None:
+        processServices(gis, services, staging, username, password, pipeline, fingerprints, cache_settings, index)
+    runTasks(gis, tasks, indexes)
     Log("[INFO] Completed processing services")
-Log("[INFO] Writing File")
-with open(configFile, 'w') as f:
-    json.dump(config, f, indent=4, separators=(',',':'), sort_keys=True)
-Log("[INFO] DONE")
+    retrypolicy.report()
+    reports = os.path.join(sys.path[0], "reports")
+    report = os.path.join(reports, "run_{}.jsonl".format(started.strftime('%Y%m%d_%H%M%S')))
+    try:
+        if not os.path.exists(reports):
+            os.mkdir(reports)
+        writeReport(report, timings.drain(), started)
+        Log("[INFO] Wrote run report {}".format(report))
+    except Exception as e:
+        Log("[FAIL] Failed to write run report {}".format(report))
+        Log(e)
+    try:
+        saveFingerprints(fingerprintFile, fingerprints)
+    except:
+        Log("[FAIL] Failed to write fingerprint cache {}".format(fingerprintFile))
+    try:
+        stagingcache.expire(gis)
+        stagingcache.evict()
+        stagingcache.save()
+    except Exception as e:
+        Log("[FAIL] Failed to update the staging cache in {}".format(staging))
+        Log(e)
+
+def getSchedule(config):
+    # (next due, kind, position) for every service and task that can ever run
+    schedule = []
+    for position, service in enumerate(config["services"]):
+        due = getNextDue(service["sync"])
+        if service["process"] and due is not None:
+            schedule.append((due, "service", position))
+    for position, task in enumerate(config["tasks"] if "tasks" in config else []):
+        due = getNextDue(task['sync']) if 'sync' in task else None
+        if task['type'] in ['CLEAN'] and 'find' in task and due is not None:
+            schedule.append((due, "task", position))
+    return schedule
+
+def getJob(config, kind, position):
+    entry = config["services"][position] if kind == "service" else config["tasks"][position]
+    return entry, entry["name"] if kind == "service" else entry["summary"]
+
+def printPlan(config):
+    now = datetime.now()
+    schedule = sorted(getSchedule(config))
+    for due, kind, position in schedule:
+        entry, name = getJob(config, kind, position)
+        when = "due now" if due <= now else due.strftime('%Y-%m-%d %H:%M')
+        print("{:<18}{:<9}{} ({})".format(when, kind, name, entry["type"]))
+    scheduled = set((kind, position) for due, kind, position in schedule)
+    for position, service in enumerate(config["services"]):
+        if ("service", position) not in scheduled:
+            print("{:<18}{:<9}{} ({})".format("never", "service", service["name"], service["type"]))
+    print("{} of {} jobs due now".format(str(len([entry for entry in schedule if entry[0] <= now])), str(len(schedule))))
+
+def reloadSchedule(configFile, config, queue, session):
+    # Reads the configuration file again after it was edited and rebuilds the job queue from
+    # it. Jobs whose sync settings weren't edited keep their place in the queue, so one
+    # waiting for a retry isn't run at once, and changed credentials start a new session.
+    fresh = loadConfig(configFile)
+    saveConfig(configFile, fresh)
+    queued = {}
+    for due, kind, position in queue:
+        entry, name = getJob(config, kind, position)
+        queued[(kind, name)] = (due, entry["sync"])
+    schedule = []
+    for due, kind, position in getSchedule(fresh):
+        entry, name = getJob(fresh, kind, position)
+        if (kind, name) in queued and queued[(kind, name)][1] == entry["sync"]:
+            due = queued[(kind, name)][0]
+        schedule.append((due, kind, position))
+    heapq.heapify(schedule)
+    connection = ["portal", "username", "password", "daemon"]
+    if [fresh.get(setting) for setting in connection] != [config.get(setting) for setting in connection]:
+        session = Session(fresh)
+    Log("[INFO] Reloaded the configuration with {} scheduled jobs".format(str(len(schedule))))
+    return fresh, schedule, session
+
+def mergeSync(configFile, config, jobs):
+    # Writes sync.last of the jobs that ran into the configuration file as it is now, so
+    # edits made to the file while they ran are kept
+    with open(configFile, 'r') as f:
+        current = json.load(f)
+    for due, kind, position in jobs:
+        entry, name = getJob(config, kind, position)
+        if "last" not in entry["sync"]:
+            continue
+        for other in current["services"] if kind == "service" else (current["tasks"] if "tasks" in current else []):
+            if other.get("name" if kind == "service" else "summary") == name and "sync" in other:
+                other["sync"]["last"] = entry["sync"]["last"]
+    saveConfig(configFile, current)
+
+def runDaemon(configFile):
+    # Keeps one Portal session and a queue of jobs ordered by next due time, and runs the
+    # jobs as they become due. Jobs that are still due after running (they failed) are
+    # tried again after retry_minutes. The configuration file is read again whenever it
+    # changes and only sync.last is written back to it.
+    config = loadConfig(configFile)
+    saveConfig(configFile, config)
+    modified = os.path.getmtime(configFile)
+    session = Session(config)
+    queue = getSchedule(config)
+    heapq.heapify(queue)
+    Log("[INFO] Daemon started with {} scheduled jobs".format(str(len(queue))))
+    while True:
+        try:
+            changed = os.path.getmtime(configFile)
+            if changed != modified:
+                modified = changed
+                config, queue, session = reloadSchedule(configFile, config, queue, session)
+                modified = os.path.getmtime(configFile)
+        except Exception as e:
+            Log("[FAIL] Failed to reload the configuration, keeping the previous one")
+            Log(e)
+        settings = config["daemon"] if "daemon" in config else {}
+        poll = settings["poll_seconds"] if "poll_seconds" in settings else 60
+        retry = settings["retry_minutes"] if "retry_minutes" in settings else 30
+        now = datetime.now()
+        if not queue or queue[0][0] > now:
+            wait = poll if not queue else min(poll, (queue[0][0] - now).total_seconds())
+            Log.flush()
+            sleep(max(1, wait))
+            continue
+        jobs = []
+        while queue and queue[0][0] <= now:
+            jobs.append(heapq.heappop(queue))
+        services = [config["services"][position] for due, kind, position in jobs if kind == "service"]
+        tasks = [config["tasks"][position] for due, kind, position in jobs if kind == "task"]
+        Log("[INFO] Running {} due services and {} due tasks".format(str(len(services)), str(len(tasks))))
+        try:
+            runJobs(session, config, services, tasks)
+        except Exception as e:
+            # The jobs are queued again below, the ones that didn't finish are still due
+            Log("[FAIL] Failed to run the due jobs, they are retried in {} minutes".format(str(retry)))
+            Log(e)
+        try:
+            mergeSync(configFile, config, jobs)
+        except Exception as e:
+            Log("[FAIL] Failed to write the sync dates to {}".format(configFile))
+            Log(e)
+        for due, kind, position in jobs:
+            entry, name = getJob(config, kind, position)
+            try:
+                due = getNextDue(entry["sync"])
+            except Exception as e:
+                Log("[FAIL] Failed to read the sync settings of {}, retrying in {} minutes".format(name, str(retry)))
+                Log(e)
+                due = datetime.now()
+            if due is not None and due <= datetime.now():
+                due = datetime.now() + relativedelta.relativedelta(minutes=retry)
+            if due is not None:
+                heapq.heappush(queue, (due, kind, position))
+        Log.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Updates hosted layers on ArcGIS Online or Portal from ArcGIS Pro projects")
+    parser.add_argument("--plan", action="store_true", help="print when each service and task is next due and exit")
+    parser.add_argument("--daemon", action="store_true", help="keep running and process services and tasks as they become due")
+    args = parser.parse_args()
+    configFile = os.path.join(sys.path[0],"settings.config")
+    Log.start()
+
+    if args.plan:
+        with open(configFile, 'r') as f:
+            printPlan(json.load(f))
+        return
+    if args.daemon:
+        runDaemon(configFile)
+        return
+
+    config = loadConfig(configFile)
+    services = [service for service in config["services"] if isServiceDue(service)]
+    tasks = [task for task in (config["tasks"] if "tasks" in config else []) if isTaskDue(task)]
+    if services or tasks:
+        runJobs(Session(config), config, config["services"], config["tasks"] if "tasks" in config else [])
+    else:
+        Log("[INFO] Nothing is due, not connecting to Portal")
+    saveConfig(configFile, config)
+    Log("[INFO] DONE")
+    Log.flush()
+
+if __name__ == "__main__":
+    main()